@@ -0,0 +1,163 @@
+"""
+The asyncio interface of the GIF steganography suite
+
+The parsing itself is blocking, so it runs on a bounded executor, and a
+semaphore caps how many runs can be in progress at once (callers past the
+limit wait their turn rather than piling work onto the executor). asyncio
+streams can be used as the input and output, and are read and written
+incrementally from the worker thread, so a slow peer holds up only its own run.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
+import io
+import weakref
+
+from session import Session
+
+# How many runs may be in progress at once by default
+DEFAULT_LIMIT = 64
+
+class StreamFile(io.RawIOBase):
+    """
+    A blocking binary file object over an asyncio stream
+
+    Only for use from a worker thread: each call hands the stream operation
+    to the event loop and waits for it, so a StreamWriter is drained after
+    every write.
+    """
+
+    def __init__(self, stream, loop):
+        super(StreamFile, self).__init__()
+        self.stream = stream
+        self.loop = loop
+
+    def call(self, coro):
+        """
+        Run a coroutine on the event loop and wait for its result
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def readable(self):
+        return hasattr(self.stream, 'readexactly')
+
+    def writable(self):
+        return hasattr(self.stream, 'drain')
+
+    def readinto(self, buf):
+        data = self.call(self.stream.read(len(buf)))
+        buf[:len(data)] = data
+        return len(data)
+
+    def write(self, data):
+        data = bytes(data)
+        self.call(self._write(data))
+        return len(data)
+
+    async def _write(self, data):
+        self.stream.write(data)
+        await self.stream.drain()
+
+def is_stream(target):
+    """
+    Whether target is an asyncio StreamReader or StreamWriter
+    """
+    return isinstance(target, (asyncio.StreamReader, asyncio.StreamWriter))
+
+class AsyncSteg(object):
+    """
+    Runs hide and extract calls on a bounded executor
+
+    At most limit runs per event loop are in progress at once. The executor
+    defaults to a thread pool of max_workers threads; a process pool also
+    works as long as the inputs and outputs are paths or bytes (and any stats
+    callback can be pickled).
+    """
+
+    def __init__(self, limit=DEFAULT_LIMIT, max_workers=None, executor=None):
+        super(AsyncSteg, self).__init__()
+        self.limit = limit
+        self.own_executor = executor is None
+        self.executor = executor if executor is not None else ThreadPoolExecutor(max_workers)
+        # A semaphore only works on the loop it was first used on, so each
+        # loop gets its own (and it goes when the loop does)
+        self.semaphores = weakref.WeakKeyDictionary()
+
+    def semaphore(self, loop):
+        """
+        The semaphore limiting the runs started from loop
+        """
+        semaphore = self.semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self.semaphores[loop] = asyncio.Semaphore(self.limit)
+        return semaphore
+
+    async def call(self, func, *args, **kwargs):
+        """
+        Run func on the executor once there is room
+        """
+        loop = asyncio.get_running_loop()
+        async with self.semaphore(loop):
+            return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def hide(self, method, src, data, out=None, **options):
+        """
+        Hide data in the GIF src with the named method
+
+        Like the method's hide function: returns the new GIF as bytes, unless
+        out is given. src and out may also be asyncio streams.
+        """
+        loop = asyncio.get_running_loop()
+        if is_stream(src):
+            src = StreamFile(src, loop)
+        if is_stream(out):
+            out = StreamFile(out, loop)
+        return await self.call(Session(method, **options).hide, src, data, out)
+
+    async def extract(self, method, src, **options):
+        """
+        Extract the data hidden with the named method in the GIF src
+
+        src may also be an asyncio stream.
+        """
+        if is_stream(src):
+            src = StreamFile(src, asyncio.get_running_loop())
+        return await self.call(Session(method, **options).extract, src)
+
+    def close(self):
+        """
+        Shut down the executor (if it was created here)
+        """
+        if self.own_executor:
+            self.executor.shutdown()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+# Shared by ahide and aextract, created on first use
+default_steg = None
+
+def get_default():
+    """
+    The AsyncSteg used by ahide and aextract
+    """
+    global default_steg
+    if default_steg is None:
+        default_steg = AsyncSteg()
+    return default_steg
+
+async def ahide(method, src, data, out=None, **options):
+    """
+    Hide data in the GIF src with the named method (see AsyncSteg.hide)
+    """
+    return await get_default().hide(method, src, data, out, **options)
+
+async def aextract(method, src, **options):
+    """
+    Extract the data hidden with the named method in the GIF src (see AsyncSteg.extract)
+    """
+    return await get_default().extract(method, src, **options)
@@ -0,0 +1,204 @@
+"""
+The batch runner of the GIF steganography suite
+
+Runs one steganography method over many files in a pool of worker processes,
+so the interpreter startup and imports are paid once per worker rather than
+once per file. A failure on one file is recorded against that file and does
+not stop the rest of the batch.
+"""
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import base64
+import csv
+import glob
+import os
+import time
+
+from session import Session
+import structure_index
+
+# How many chunks of tasks to aim for per worker, so the work stays balanced
+# without paying for a round trip per file
+CHUNKS_PER_JOB = 4
+
+# One file's worth of work
+#   out_file and payload are None when extracting
+#   options are the extra keyword arguments for the method's steg function
+#   method 'auto' picks a method per file when hiding (see auto.py)
+#   error, if set, fails the task without running it
+Task = namedtuple('Task', ['method', 'in_file', 'out_file', 'payload', 'options', 'error'], defaults=(None,))
+
+def is_pattern(path):
+    """
+    Whether a path contains glob wildcards
+    """
+    return glob.escape(path) != path
+
+def glob_root(pattern):
+    """
+    The directory a glob pattern is rooted at, the part before any wildcards
+    """
+    root = os.path.dirname(pattern)
+    while is_pattern(root):
+        root = os.path.dirname(root)
+    return root or os.curdir
+
+def expand_inputs(paths):
+    """
+    Expand globs and directories into the list of files they name
+
+    Directories are searched recursively for .gif files. Each file comes with
+    its path relative to whatever named it (the directory, or the part of the
+    glob before any wildcards), for laying out the outputs.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                for name in sorted(names):
+                    if name.lower().endswith('.gif'):
+                        full = os.path.join(root, name)
+                        files.append((full, os.path.relpath(full, path)))
+        elif is_pattern(path):
+            for match in sorted(glob.glob(path, recursive=True)):
+                if os.path.isfile(match):
+                    files.append((match, os.path.relpath(match, glob_root(path))))
+        else:
+            files.append((path, os.path.basename(path)))
+    return files
+
+def is_batch(paths):
+    """
+    Whether the input paths name more than a single file
+    """
+    return len(paths) != 1 or is_pattern(paths[0]) or os.path.isdir(paths[0])
+
+def output_key(path):
+    """
+    A key that is the same for any two spellings of the same output path
+    """
+    return os.path.normcase(os.path.abspath(path))
+
+def check_outputs(tasks):
+    """
+    Fail every task that would write to the same output file as another
+
+    Rather than letting the last one (or two at once) win, each of them gets
+    an error naming the inputs it clashes with, and the rest of the batch
+    goes ahead.
+    """
+    writers = {}
+    for task in tasks:
+        if task.out_file is not None:
+            writers.setdefault(output_key(task.out_file), []).append(task.in_file)
+    checked = []
+    for task in tasks:
+        if task.out_file is not None and len(writers[output_key(task.out_file)]) > 1:
+            clashes = ', '.join(writers[output_key(task.out_file)])
+            task = task._replace(error=f'{task.out_file} would be written by several input files ({clashes})')
+        checked.append(task)
+    return checked
+
+def hide_tasks(method, payload, paths, out_dir, options):
+    """
+    The tasks to hide the same payload in each of the input files
+    """
+    return check_outputs([Task(method, in_file, os.path.join(out_dir, rel_path), payload, options)
+                          for in_file, rel_path in expand_inputs(paths)])
+
+def extract_tasks(method, paths, options):
+    """
+    The tasks to extract the data from each of the input files
+    """
+    return [Task(method, in_file, None, None, options) for in_file, _ in expand_inputs(paths)]
+
+def read_manifest(method, path, options):
+    """
+    The tasks listed in a manifest file
+
+    The manifest is CSV with one file per row: payload, input file and output
+    file to hide data, or just the input file to extract it. Blank lines and
+    lines starting with # are ignored.
+    """
+    tasks = []
+    with open(path, newline='', encoding='utf-8') as manifest:
+        for line_num, row in enumerate(csv.reader(manifest), 1):
+            if not row or row[0].startswith('#'):
+                continue
+            if len(row) == 3:
+                payload, in_file, out_file = row
+                tasks.append(Task(method, in_file, out_file, payload.encode('utf-8'), options))
+            elif len(row) == 1:
+                tasks.append(Task(method, row[0], None, None, options))
+            else:
+                raise RuntimeError(f'{path}:{line_num}: expected payload,in_file,out_file or in_file')
+    return check_outputs(tasks)
+
+def run_task(task):
+    """
+    Carry out one task, returning a summary of how it went
+
+    Any error is caught and reported in the summary rather than raised, so
+    one bad file doesn't take the whole batch down with it.
+    """
+    summary = {'method': task.method, 'in_file': task.in_file}
+    if task.out_file is not None:
+        summary['out_file'] = task.out_file
+    start = time.perf_counter()
+    try:
+        if task.error is not None:
+            raise RuntimeError(task.error)
+        if task.out_file is not None:
+            out_dir = os.path.dirname(task.out_file)
+            if out_dir:
+                os.makedirs(out_dir, exist_ok=True)
+            if task.method == 'auto':
+                # Record what was picked, for extracting it again
+                import auto
+                choice, _ = auto.hide(task.in_file, task.payload, task.out_file, **task.options)
+                summary['method'] = choice.method
+                summary['options'] = choice.options
+            else:
+                Session(task.method, **task.options).steg(task.in_file, task.out_file, task.payload)
+        else:
+            if task.method == 'auto':
+                raise RuntimeError('Data can only be extracted with the method that hid it')
+            data = bytes(Session(task.method, **task.options).steg(task.in_file) or b'')
+            try:
+                summary['data'] = data.decode('utf-8')
+            except UnicodeDecodeError:
+                summary['data_base64'] = base64.b64encode(data).decode('ascii')
+        summary['ok'] = True
+    except Exception as e:
+        summary['ok'] = False
+        summary['error'] = f'{type(e).__name__}: {e}'
+    summary['seconds'] = round(time.perf_counter() - start, 6)
+    return summary
+
+def run_batch(tasks, jobs=None, chunksize=None, index_path=None):
+    """
+    Carry out the tasks across a pool of jobs worker processes
+
+    Yields the summary of each task, in the same order as the tasks. The
+    tasks are handed to the workers chunksize at a time (by default, enough
+    for a few chunks per worker). If index_path is given, the workers share
+    the structure index there (see structure_index.py).
+    """
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    jobs = max(1, min(jobs, len(tasks)))
+    if jobs == 1:
+        # Not worth starting any processes
+        if index_path is not None:
+            structure_index.install(index_path)
+        for task in tasks:
+            yield run_task(task)
+        return
+
+    if chunksize is None:
+        chunksize = max(1, len(tasks) // (jobs * CHUNKS_PER_JOB))
+    initializer, initargs = (structure_index.install, (index_path,)) if index_path is not None else (None, ())
+    with ProcessPoolExecutor(max_workers=jobs, initializer=initializer, initargs=initargs) as executor:
+        yield from executor.map(run_task, tasks, chunksize=chunksize)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+"""
+The benchmark harness of the GIF steganography suite
+
+Runs hide and extract for each method over each sample GIF, reporting the
+throughput, per-call latency percentiles and peak traced memory. The results
+can be saved as a baseline, and a later run compared against it fails if any
+method got slower (or hungrier) by more than the threshold.
+"""
+
+import argparse
+import glob
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from session import METHODS, Session
+
+# The data hidden in every carrier (small enough to fit in all of them)
+PAYLOAD = b'benchmark'
+
+def percentile(values, fraction):
+    """
+    The value below which the given fraction of the (sorted) values fall
+    """
+    index = min(len(values) - 1, max(0, round(fraction * (len(values) - 1))))
+    return values[index]
+
+def measure(func, repeat):
+    """
+    Time repeat calls of func, then trace the memory of one more
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    times.sort()
+
+    # Tracing slows everything down, so it gets a call of its own
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return times, peak
+
+def bench_case(method, in_path, out_path, repeat):
+    """
+    Benchmark hiding in and extracting from one file with one method
+    """
+    session = Session(method)
+    size = os.path.getsize(in_path)
+    results = {}
+    for op, func in (('hide', lambda: session.hide(in_path, PAYLOAD, out_path)),
+                     ('extract', lambda: session.extract(out_path))):
+        times, peak = measure(func, repeat)
+        results[op] = {
+            'bytes': size,
+            'mb_per_s': size / statistics.median(times) / 1e6,
+            'p50_ms': percentile(times, 0.5) * 1000,
+            'p90_ms': percentile(times, 0.9) * 1000,
+            'p99_ms': percentile(times, 0.99) * 1000,
+            'peak_kb': peak / 1024,
+        }
+    return results
+
+def summarize(cases):
+    """
+    The overall figures for each method and operation across all the files
+    """
+    totals = {}
+    for case in cases:
+        for op, result in case['results'].items():
+            total = totals.setdefault(f"{case['method']}.{op}", {'bytes': 0, 'seconds': 0.0, 'peak_kb': 0.0})
+            total['bytes'] += result['bytes']
+            total['seconds'] += result['bytes'] / result['mb_per_s'] / 1e6
+            total['peak_kb'] = max(total['peak_kb'], result['peak_kb'])
+    return {name: {'mb_per_s': total['bytes'] / total['seconds'] / 1e6, 'peak_kb': total['peak_kb']}
+            for name, total in totals.items()}
+
+def compare(summary, baseline, threshold):
+    """
+    List how each method fell behind the baseline by more than threshold
+    """
+    regressions = []
+    for name, result in sorted(summary.items()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['mb_per_s'] < base['mb_per_s'] * (1 - threshold):
+            regressions.append(f"{name}: {result['mb_per_s']:.2f} MB/s, was {base['mb_per_s']:.2f} MB/s")
+        if result['peak_kb'] > base['peak_kb'] * (1 + threshold):
+            regressions.append(f"{name}: peak {result['peak_kb']:.0f} KiB, was {base['peak_kb']:.0f} KiB")
+    return regressions
+
+def main():
+    """
+    The main function
+
+    Parses arguments from the command line and runs the benchmarks.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Benchmark the steganography methods.')
+    parser.add_argument('gifs', nargs='*', default=sorted(glob.glob(os.path.join(here, 'GIFs', '*.gif'))),
+                        help='The carriers to benchmark with (default: the GIFs directory)')
+    parser.add_argument('-m', '--method', action='append', choices=METHODS,
+                        help='Benchmark only this method (may be repeated)')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='Timed calls per file and operation (default: %(default)s)')
+    parser.add_argument('--save', metavar='JSON',
+                        help='Save the results as a baseline')
+    parser.add_argument('--baseline', metavar='JSON',
+                        help='Compare the results against a saved baseline')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='The fraction a method may regress by before failing (default: %(default)s)')
+    args = parser.parse_args()
+
+    cases = []
+    print(f"{'method':<10} {'file':<14} {'op':<8} {'MB/s':>8} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'peak KiB':>9}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for method in args.method or METHODS:
+            for in_path in args.gifs:
+                out_path = os.path.join(tmp_dir, f'{method}-{os.path.basename(in_path)}')
+                results = bench_case(method, in_path, out_path, args.repeat)
+                cases.append({'method': method, 'file': os.path.basename(in_path), 'results': results})
+                for op, r in results.items():
+                    print(f"{method:<10} {os.path.basename(in_path):<14} {op:<8} {r['mb_per_s']:>8.2f} "
+                          f"{r['p50_ms']:>9.3f} {r['p90_ms']:>9.3f} {r['p99_ms']:>9.3f} {r['peak_kb']:>9.0f}")
+
+    summary = summarize(cases)
+    print()
+    for name, result in sorted(summary.items()):
+        print(f"{name:<20} {result['mb_per_s']:>8.2f} MB/s {result['peak_kb']:>9.0f} KiB peak")
+
+    if args.save:
+        with open(args.save, 'w') as out_f:
+            json.dump({'summary': summary, 'cases': cases}, out_f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as in_f:
+            baseline = json.load(in_f)['summary']
+        regressions = compare(summary, baseline, args.threshold)
+        if regressions:
+            print('\nRegressed past the threshold:', file=sys.stderr)
+            for regression in regressions:
+                print(f'  {regression}', file=sys.stderr)
+            return 1
+    return 0
+
+# Run the main function if loaded directly
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,166 @@
+"""
+The capacity report of the GIF steganography suite
+
+Works out how much each method can hide in each file of a carrier library,
+from a single pass that reads only the headers, descriptors and Color Tables
+of each file. The results are cached against each file's size and
+modification time, so only new or changed files are looked at again.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+
+from batch import expand_inputs
+from gif_parser import Handler, run
+import lsb
+import shuffle
+
+# The ways of hiding data, by the name used in the report
+#   None means there is no limit, and -1 that not even empty data fits
+VARIANTS = ('append', 'comment', 'extension', 'lsb', 'lsb_bits1', 'lsb_bits2', 'lsb_bits3', 'lsb_bits4',
+            'shuffle', 'shuffle_striped')
+
+# The variants with no limit on how much they can hide
+UNLIMITED = ('append', 'comment', 'extension')
+
+# The name of the cache file kept in a carrier directory
+CACHE_FILE = '.gifsteg-capacity.json'
+
+# The version of the cache layout (bump to throw away old caches)
+CACHE_VERSION = 2
+
+def variant_name(method, options):
+    """
+    The report name for a method and its options
+    """
+    if options.get('bits'):
+        return f"{method}_bits{options['bits']}"
+    if options.get('striped'):
+        return f'{method}_striped'
+    return method
+
+class TableSummary(Handler):
+    """
+    Collect the size and the shuffle radix of every Color Table
+    """
+
+    def __init__(self):
+        super(TableSummary, self).__init__()
+        self.sizes = []
+        self.radices = []
+
+    def color_table(self, event):
+        self.sizes.append(len(event.data))
+        self.radices.append(shuffle.table_radix(event.data))
+
+    def result(self):
+        return self.sizes, self.radices
+
+def table_summary(path):
+    """
+    The size and the shuffle radix of every Color Table in a file
+    """
+    return run(path, None, TableSummary())
+
+def file_capacities(path, tables=None):
+    """
+    The number of bytes each variant can hide in a file
+
+    tables is the file's table_summary, if it has already been read.
+    """
+    sizes, radices = table_summary(path) if tables is None else tables
+    capacities = dict.fromkeys(UNLIMITED)
+    capacities['lsb'] = lsb.sizes_capacity(sizes)
+    for bits in range(1, 5):
+        capacities[f'lsb_bits{bits}'] = lsb.sizes_capacity(sizes, bits)
+    capacities['shuffle'] = shuffle.radices_capacity(radices)
+    capacities['shuffle_striped'] = shuffle.radices_capacity(radices, True)
+    return capacities
+
+def file_entry(path):
+    """
+    The report entry for a file (its capacities, or the error reading it)
+    """
+    entry = {'path': path}
+    try:
+        entry['capacity'] = file_capacities(path)
+    except (OSError, RuntimeError) as e:
+        entry['error'] = f'{type(e).__name__}: {e}'
+    return entry
+
+def file_key(path):
+    """
+    What a cached entry has to match to still be good
+    """
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def load_cache(cache_path):
+    """
+    Read a cache file (an empty cache if it is missing or out of date)
+    """
+    try:
+        with open(cache_path, encoding='utf-8') as cache_f:
+            cache = json.load(cache_f)
+        if cache.get('version') == CACHE_VERSION:
+            return cache['files']
+    except (OSError, ValueError, KeyError):
+        pass
+    return {}
+
+def save_cache(cache_path, files):
+    """
+    Write a cache file (atomically, so a reader never sees half of it)
+    """
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as cache_f:
+        json.dump({'version': CACHE_VERSION, 'files': files}, cache_f)
+    os.replace(tmp_path, cache_path)
+
+def report(paths, sort_by='lsb', cache_path=None, jobs=1):
+    """
+    The capacity of every file named by paths (files, globs or directories)
+
+    Entries are sorted with the most capacity for sort_by (a name from
+    VARIANTS) first. Only files that are new or have changed since the cache
+    was written are read, across jobs worker processes.
+    """
+    files = [path for path, _ in expand_inputs(paths)]
+    cache = load_cache(cache_path) if cache_path else {}
+
+    entries = {}
+    stale = []
+    for path in files:
+        try:
+            key = file_key(path)
+        except OSError as e:
+            entries[path] = {'path': path, 'error': f'{type(e).__name__}: {e}'}
+            continue
+        cached = cache.get(path)
+        if cached is not None and cached['key'] == key:
+            entries[path] = cached['entry']
+        else:
+            stale.append((path, key))
+
+    if jobs > 1 and len(stale) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            fresh = list(executor.map(file_entry, [path for path, _ in stale], chunksize=16))
+    else:
+        fresh = [file_entry(path) for path, _ in stale]
+    for (path, key), entry in zip(stale, fresh):
+        entries[path] = entry
+        if 'error' not in entry:
+            cache[path] = {'key': key, 'entry': entry}
+
+    if cache_path and stale:
+        # Forget files that no longer exist
+        save_cache(cache_path, {path: cached for path, cached in cache.items() if os.path.exists(path)})
+
+    def sort_key(entry):
+        # Unlimited first, then the most capacity, with unreadable files last
+        if 'error' in entry:
+            return (2, 0, entry['path'])
+        capacity = entry['capacity'][sort_by]
+        return (capacity is not None, -(capacity or 0), entry['path'])
+    return sorted((entries[path] for path in files), key=sort_key)
@@ -0,0 +1,182 @@
+"""
+The payload compression of the GIF steganography suite
+
+Compressed data is hidden behind a two byte header: a magic byte, then the
+codec in the high four bits and the level in the low four. The header is
+what lets extraction undo the compression without being told how it was
+done. Both codecs are used without their own framing (raw deflate and raw
+LZMA2), since every byte counts in the methods with the least room.
+"""
+
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    # Python can be built without it
+    lzma = None
+
+# What the decompressors raise when the compressed data is corrupt
+DECOMPRESS_ERRORS = (zlib.error,) if lzma is None else (zlib.error, lzma.LZMAError)
+
+# The first byte of every compressed payload
+MAGIC = 0xC5
+
+# How many bytes the header adds
+HEADER_SIZE = 2
+
+# The codecs, by their number in the header (stored means not compressed at all)
+CODECS = ('stored', 'zlib', 'lzma')
+
+# The level used when none is given
+DEFAULT_LEVELS = {'stored': 0, 'zlib': 9, 'lzma': 6}
+
+# Payloads up to this size are compressed with every codec to find the
+# smallest result. Larger ones are streamed through zlib, unless the first
+# chunk shows they don't compress.
+TRIAL_LIMIT = 1 << 16
+
+# How much of a large payload to compress at a time
+CHUNK_SIZE = 1 << 16
+
+# The level large payloads are streamed at
+STREAM_LEVEL = 6
+
+# A chunk that compresses to more than this fraction of its size isn't worth compressing
+MAX_RATIO = 0.9
+
+def available():
+    """
+    The codecs that can be used here
+    """
+    return tuple(codec for codec in CODECS if codec != 'lzma' or lzma is not None)
+
+def lzma_filters(level):
+    """
+    The raw LZMA2 filter chain for a level
+    """
+    return [{'id': lzma.FILTER_LZMA2, 'preset': level}]
+
+def compressor(codec, level):
+    """
+    A compressor object (with compress and flush methods) for a codec
+    """
+    if codec == 'zlib':
+        return zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    if codec == 'lzma':
+        if lzma is None:
+            raise RuntimeError('The lzma codec is not available')
+        return lzma.LZMACompressor(lzma.FORMAT_RAW, filters=lzma_filters(level))
+    raise RuntimeError(f'Unknown codec {codec!r}')
+
+def header(codec, level):
+    """
+    The header for data compressed with a codec at a level
+    """
+    return bytes([MAGIC, CODECS.index(codec) << 4 | level])
+
+def compress(data, codec, level=None):
+    """
+    Compress data with a codec, header and all
+    """
+    if level is None:
+        level = DEFAULT_LEVELS[codec]
+    if not 0 <= level <= 9:
+        raise RuntimeError(f'The level must be from 0 to 9, not {level}')
+    if codec == 'stored':
+        return header(codec, 0) + bytes(data)
+    compressor_obj = compressor(codec, level)
+    return header(codec, level) + compressor_obj.compress(data) + compressor_obj.flush()
+
+def stream(data, level=None):
+    """
+    Compress a large payload with zlib a chunk at a time, or store it if the first chunk doesn't compress
+    """
+    level = STREAM_LEVEL if level is None else level
+    view = memoryview(data).cast('B')
+    # A quick look at the first chunk says whether the rest is worth the effort
+    if len(zlib.compress(view[:CHUNK_SIZE], 1)) > len(view[:CHUNK_SIZE]) * MAX_RATIO:
+        return compress(data, 'stored')
+    compressor_obj = compressor('zlib', level)
+    pieces = [header('zlib', level)]
+    for start in range(0, len(view), CHUNK_SIZE):
+        pieces.append(compressor_obj.compress(view[start:start + CHUNK_SIZE]))
+    pieces.append(compressor_obj.flush())
+    return b''.join(pieces)
+
+def pack(data, codec='auto', level=None):
+    """
+    The payload to hide for data, compressed with codec
+
+    With codec 'auto', small payloads get whichever codec (or none) makes them
+    smallest, and large ones are streamed through zlib.
+    """
+    if codec != 'auto':
+        return compress(data, codec, level)
+    if len(data) > TRIAL_LIMIT:
+        return stream(data, level)
+    return min((compress(data, codec, level) for codec in available()), key=len)
+
+class Unpacker(object):
+    """
+    Undoes pack a piece at a time, for payloads that arrive in pieces
+
+    Each piece fed in gives back whatever of the original data it completes.
+    """
+
+    def __init__(self):
+        super(Unpacker, self).__init__()
+        self.header = bytearray()
+        self.codec = None
+        self.decompressor = None
+
+    def feed(self, piece):
+        """
+        Take the next piece of the payload, returning the data it completes
+        """
+        piece = memoryview(piece).cast('B')
+        if self.codec is None:
+            # Still waiting for (the rest of) the header
+            needed = HEADER_SIZE - len(self.header)
+            self.header += piece[:needed]
+            piece = piece[needed:]
+            if len(self.header) < HEADER_SIZE:
+                return b''
+            if self.header[0] != MAGIC or self.header[1] >> 4 >= len(CODECS):
+                raise RuntimeError('The hidden data was not compressed')
+            self.codec, level = CODECS[self.header[1] >> 4], self.header[1] & 0x0F
+            if self.codec == 'zlib':
+                self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            elif self.codec == 'lzma':
+                if lzma is None:
+                    raise RuntimeError('The lzma codec is not available')
+                self.decompressor = lzma.LZMADecompressor(lzma.FORMAT_RAW, filters=lzma_filters(level))
+        if self.decompressor is None:
+            return bytes(piece)
+        try:
+            return self.decompressor.decompress(piece)
+        except DECOMPRESS_ERRORS as e:
+            raise RuntimeError(f'The compressed data is corrupt ({e})') from None
+
+    def finish(self):
+        """
+        Check that the whole payload went in, returning any data still held back
+        """
+        if self.codec is None:
+            raise RuntimeError('The hidden data was not compressed')
+        if self.decompressor is None:
+            return b''
+        try:
+            data = self.decompressor.flush() if self.codec == 'zlib' else b''
+        except DECOMPRESS_ERRORS as e:
+            raise RuntimeError(f'The compressed data is corrupt ({e})') from None
+        if not self.decompressor.eof:
+            raise RuntimeError('The compressed data is truncated')
+        return data
+
+def unpack(payload):
+    """
+    The original data from a payload made by pack
+    """
+    unpacker = Unpacker()
+    return unpacker.feed(payload) + unpacker.finish()
@@ -0,0 +1,1106 @@
+"""
+The shared block parser of the GIF steganography suite
+
+Every steganography method walks the same GIF structure, so the walking lives
+here once. The parser reads the input (in place if it is already in memory,
+memory mapped where possible, otherwise in large chunks) and yields one typed
+event per structural element of the file. Each method then plugs in as a
+Handler that decides what (if anything) to change about each event.
+Everything a Handler leaves alone is copied from the input to the output by
+the kernel where it can be, without passing through Python at all.
+"""
+
+from collections import namedtuple
+from contextlib import ExitStack
+import io
+import mmap
+import os
+import stat
+import struct
+import time
+
+from stats import CountingFile, Stats, TimedHandler
+
+# How much of the input to pull in per read call
+CHUNK_SIZE = 1 << 20
+
+# How far past the bytes it needs a RangeReader fetches, to take in nearby elements
+RANGE_GAP = 32
+
+# The events produced by the parser
+#   offset is the position of the element in the input file
+#   data is the raw bytes of the element exactly as they appear in the input
+Header = namedtuple('Header', ['offset', 'data', 'signature', 'version'])
+ScreenDescriptor = namedtuple('ScreenDescriptor', ['offset', 'data', 'width', 'height', 'packed',
+                                                   'bg_color_index', 'aspect_ratio', 'has_ct', 'ct_size'])
+ColorTable = namedtuple('ColorTable', ['offset', 'data', 'is_global'])
+ImageDescriptor = namedtuple('ImageDescriptor', ['offset', 'data', 'left_pos', 'top_pos', 'width', 'height',
+                                                 'packed', 'has_ct', 'interlace', 'ct_size'])
+# data is the LZW Minimum Code Size byte followed by the raw sub-blocks (including the terminator)
+ImageData = namedtuple('ImageData', ['offset', 'data', 'lzw_min_size'])
+# data is the introducer and label followed by the raw sub-blocks (including the terminator)
+Extension = namedtuple('Extension', ['offset', 'data', 'label'])
+Trailer = namedtuple('Trailer', ['offset', 'data'])
+Trailing = namedtuple('Trailing', ['offset', 'data'])
+
+def color_table_size(ct_size):
+    """
+    Convert the packed Color Table size field to a length in bytes
+    """
+    return 3 * (2 ** (ct_size + 1))
+
+def screen_descriptor_event(offset, data):
+    """
+    The event for a Logical Screen Descriptor
+    """
+    width, height, packed, bg_color_index, aspect_ratio = struct.unpack('<2H3B', data)
+    has_gct   = (packed & 0b10000000) >> 7
+    gct_size  = (packed & 0b00000111) >> 0
+    return ScreenDescriptor(offset, data, width, height, packed, bg_color_index, aspect_ratio, has_gct, gct_size)
+
+def image_descriptor_event(offset, data):
+    """
+    The event for an Image Descriptor (data includes the separator)
+    """
+    left_pos, top_pos, width, height, packed = struct.unpack('<4HB', data[1:10])
+    has_lct   = (packed & 0b10000000) >> 7
+    interlace = (packed & 0b01000000) >> 6
+    lct_size  = (packed & 0b00000111) >> 0
+    return ImageDescriptor(offset, data, left_pos, top_pos, width, height, packed, has_lct, interlace, lct_size)
+
+def iter_sub_blocks(data, start=0):
+    """
+    Yield the contents of each of a chain of raw sub-blocks starting at start
+    """
+    pos = start
+    while True:
+        block_size = data[pos]
+        if block_size == 0:
+            break
+        yield data[pos + 1:pos + 1 + block_size]
+        pos += block_size + 1
+
+def sub_block_data(data, start=0):
+    """
+    Join the contents of a chain of raw sub-blocks starting at start
+    """
+    return b''.join(iter_sub_blocks(data, start))
+
+def make_sub_blocks(data):
+    """
+    Split data into a chain of raw sub-blocks (including the terminator)
+    """
+    out = bytearray()
+    for pos in range(0, len(data), 255):
+        chunk = data[pos:pos + 255]
+        out.append(len(chunk))
+        out += chunk
+    out.append(0)
+    return bytes(out)
+
+class Reader(object):
+    """
+    A chunked reader over a binary file
+
+    Keeps a single large buffer and hands out slices of it, so each GIF element
+    costs a slice rather than a call down into the file object.
+    """
+
+    def __init__(self, in_f, chunk_size=CHUNK_SIZE):
+        super(Reader, self).__init__()
+        self.in_f = in_f
+        self.chunk_size = chunk_size
+        self.buf = bytearray()
+        # Position within buf, the file offset of buf[0], and the file offset
+        # of the start of the current element
+        self.pos = 0
+        self.base = 0
+        self.marked = 0
+
+    @property
+    def offset(self):
+        """
+        The file offset of the next unread byte
+        """
+        return self.base + self.pos
+
+    def mark(self):
+        """
+        Start a new element at the current offset, returning that offset
+        """
+        self.marked = self.base + self.pos
+        return self.marked
+
+    def since_mark(self):
+        """
+        The raw bytes of the current element
+        """
+        return bytes(self.buf[self.marked - self.base:self.pos])
+
+    def _fill(self, needed):
+        """
+        Make sure at least needed bytes are available past pos
+
+        Returns False if the file ended first.
+        """
+        if len(self.buf) - self.pos >= needed:
+            return True
+        # Drop everything before the current element before growing the buffer
+        drop = self.marked - self.base
+        if drop:
+            del self.buf[:drop]
+            self.base += drop
+            self.pos -= drop
+        while len(self.buf) - self.pos < needed:
+            chunk = self.in_f.read(max(self.chunk_size, needed - len(self.buf) + self.pos))
+            if not chunk:
+                return False
+            self.buf += chunk
+        return True
+
+    def expect(self, size):
+        """
+        A hint that the next size bytes will be read
+        """
+        pass
+
+    def read(self, size, error):
+        """
+        Read exactly size bytes, raising a RuntimeError with the given message if short
+        """
+        if not self._fill(size):
+            raise RuntimeError(error)
+        data = self.buf[self.pos:self.pos + size]
+        self.pos += size
+        return data
+
+    def skip(self, size, keep, error):
+        """
+        Move past exactly size bytes, raising a RuntimeError with the given message if short
+        """
+        self.read(size, error)
+
+    def read_byte(self, error):
+        """
+        Read a single byte as an integer
+        """
+        if not self._fill(1):
+            raise RuntimeError(error)
+        byte = self.buf[self.pos]
+        self.pos += 1
+        return byte
+
+    def skip_sub_blocks(self, keep=True):
+        """
+        Move past a chain of sub-blocks (including the terminator)
+        """
+        while True:
+            # Read the block size, then make sure the block itself is buffered
+            block_size = self.read_byte('The Block is too short to be valid')
+            if not self._fill(block_size):
+                raise RuntimeError('The Block is shorter than specified')
+            self.pos += block_size
+            # Length zero block signals the end of the data
+            if block_size == 0:
+                break
+
+    def skip_rest(self, keep=True):
+        """
+        Move past everything left in the file
+        """
+        while self._fill(len(self.buf) - self.pos + 1):
+            pass
+        self.pos = len(self.buf)
+
+    def close(self):
+        pass
+
+class BufferReader(object):
+    """
+    A reader over a bytes-like object already in memory
+
+    Hands out memoryview slices of the buffer, so nothing is copied unless a
+    Handler asks for it.
+    """
+
+    def __init__(self, buf):
+        super(BufferReader, self).__init__()
+        self.buf = memoryview(buf).cast('B')
+        self.pos = 0
+        self.marked = 0
+
+    @property
+    def offset(self):
+        """
+        The file offset of the next unread byte
+        """
+        return self.pos
+
+    def mark(self):
+        """
+        Start a new element at the current offset, returning that offset
+        """
+        self.marked = self.pos
+        return self.marked
+
+    def since_mark(self):
+        """
+        The raw bytes of the current element
+        """
+        return self.buf[self.marked:self.pos]
+
+    def expect(self, size):
+        """
+        A hint that the next size bytes will be read
+        """
+        pass
+
+    def read(self, size, error):
+        """
+        Read exactly size bytes, raising a RuntimeError with the given message if short
+        """
+        if self.pos + size > len(self.buf):
+            raise RuntimeError(error)
+        data = self.buf[self.pos:self.pos + size]
+        self.pos += size
+        return data
+
+    def skip(self, size, keep, error):
+        """
+        Move past exactly size bytes, raising a RuntimeError with the given message if short
+        """
+        if self.pos + size > len(self.buf):
+            raise RuntimeError(error)
+        self.pos += size
+
+    def read_byte(self, error):
+        """
+        Read a single byte as an integer
+        """
+        if self.pos >= len(self.buf):
+            raise RuntimeError(error)
+        byte = self.buf[self.pos]
+        self.pos += 1
+        return byte
+
+    def skip_sub_blocks(self, keep=True):
+        """
+        Move past a chain of sub-blocks (including the terminator)
+        """
+        buf = self.buf
+        end = self.pos
+        while True:
+            if end >= len(buf):
+                raise RuntimeError('The Block is too short to be valid')
+            block_size = buf[end]
+            end += block_size + 1
+            # Length zero block signals the end of the data
+            if block_size == 0:
+                break
+        if end > len(buf):
+            raise RuntimeError('The Block is shorter than specified')
+        self.pos = end
+
+    def skip_rest(self, keep=True):
+        """
+        Move past everything left in the file
+        """
+        self.pos = len(self.buf)
+
+    def close(self):
+        """
+        Let go of the buffer
+        """
+        self.buf.release()
+
+class MappedReader(BufferReader):
+    """
+    A reader over a memory mapped file
+    """
+
+    def __init__(self, in_f):
+        self.mapping = mmap.mmap(in_f.fileno(), 0, access=mmap.ACCESS_READ)
+        super(MappedReader, self).__init__(self.mapping)
+
+    def close(self):
+        """
+        Release the mapping
+        """
+        super(MappedReader, self).close()
+        try:
+            self.mapping.close()
+        except BufferError:
+            # An event is still holding a slice (e.g. the parse was abandoned
+            # part way through), so leave the unmapping to the garbage collector
+            pass
+
+class SeekReader(object):
+    """
+    A reader for extraction, where nothing needs to be copied
+
+    Reads only the elements the Handler asked for. Every other sub-block costs
+    just a read of its length and a seek past its contents.
+    """
+
+    def __init__(self, in_f):
+        super(SeekReader, self).__init__()
+        self.in_f = in_f
+        self.size = in_f.seek(0, os.SEEK_END)
+        in_f.seek(0)
+        self.pos = 0
+        self.element = bytearray()
+        self.skipped = False
+
+    @property
+    def offset(self):
+        """
+        The file offset of the next unread byte
+        """
+        return self.pos
+
+    def mark(self):
+        """
+        Start a new element at the current offset, returning that offset
+        """
+        self.element = bytearray()
+        self.skipped = False
+        return self.pos
+
+    def since_mark(self):
+        """
+        The raw bytes of the current element (None if any of it was skipped)
+        """
+        if self.skipped:
+            return None
+        return bytes(self.element)
+
+    def _take(self, size):
+        """
+        Get (up to) the next size bytes of the input
+        """
+        return self.in_f.read(size)
+
+    def _skip(self, size):
+        """
+        Move past the next size bytes of the input without reading them
+        """
+        self.in_f.seek(size, os.SEEK_CUR)
+
+    def expect(self, size):
+        """
+        A hint that the next size bytes will be read
+        """
+        pass
+
+    def read(self, size, error):
+        """
+        Read exactly size bytes, raising a RuntimeError with the given message if short
+        """
+        data = self._take(size)
+        if len(data) != size:
+            raise RuntimeError(error)
+        self.element += data
+        self.pos += size
+        return data
+
+    def skip(self, size, keep, error):
+        """
+        Move past exactly size bytes, raising a RuntimeError with the given message if short
+
+        The bytes are only read if keep is set.
+        """
+        if keep:
+            self.read(size, error)
+            return
+        self._skip(size)
+        self.pos += size
+        self.skipped = True
+        if self.size is not None and self.pos > self.size:
+            raise RuntimeError(error)
+
+    def read_byte(self, error):
+        """
+        Read a single byte as an integer
+        """
+        return self.read(1, error)[0]
+
+    def skip_sub_blocks(self, keep=True):
+        """
+        Move past a chain of sub-blocks (including the terminator)
+
+        The contents are only read if keep is set.
+        """
+        while True:
+            block_size = self.read_byte('The Block is too short to be valid')
+            if keep:
+                # The contents and the size of the next block
+                self.expect(block_size + 1)
+                self.read(block_size, 'The Block is shorter than specified')
+            elif block_size:
+                self._skip(block_size)
+                self.pos += block_size
+                self.skipped = True
+                if self.size is not None and self.pos > self.size:
+                    raise RuntimeError('The Block is shorter than specified')
+            # Length zero block signals the end of the data
+            if block_size == 0:
+                break
+
+    def skip_rest(self, keep=True):
+        """
+        Move past everything left in the file
+
+        The contents are only read if keep is set.
+        """
+        if keep:
+            self.read(self.size - self.pos, 'The input file ended unexpectedly')
+        else:
+            self._skip(self.size - self.pos)
+            self.pos = self.size
+            self.skipped = True
+
+    def close(self):
+        pass
+
+class RangeReader(SeekReader):
+    """
+    A reader for extraction from range-addressable storage
+
+    The source is any object with a read_range(offset, length) method that
+    returns (up to) length bytes starting at offset, and optionally a size
+    attribute. The parser plans ahead (see expect) so that the pieces it needs
+    back to back are fetched in a single range. A Color Table, say, comes in
+    the same range as the LZW Minimum Code Size and the first sub-block size
+    after it.
+
+    Each range also takes in the gap bytes after what was asked for, so that
+    nearby elements come along with it: the end of an image, the Graphic
+    Control Extension and Image Descriptor of the next one are usually a
+    single range. The sizes of a skipped image's full sub-blocks are the
+    exception, a byte every 256, and are fetched alone. A gap of 0 fetches
+    strictly the bytes needed. It defaults to the source's gap attribute, if
+    it has one.
+    """
+
+    def __init__(self, source, gap=None):
+        # Deliberately not calling SeekReader's constructor, there is no file
+        self.source = source
+        self.size = getattr(source, 'size', None)
+        if gap is None:
+            gap = getattr(source, 'gap', RANGE_GAP)
+        self.gap = gap
+        self.pos = 0
+        self.element = bytearray()
+        self.skipped = False
+        # The most recently fetched range
+        self.window = b''
+        self.window_start = 0
+
+    def _fetch(self, size, gap):
+        """
+        Fetch the next size bytes, and the gap bytes after them, into the window
+
+        Nothing is fetched if the window already holds the next size bytes.
+        """
+        start = self.pos - self.window_start
+        if 0 <= start and start + size <= len(self.window):
+            return
+        size += gap
+        if self.size is not None:
+            size = max(0, min(size, self.size - self.pos))
+        self.window = self.source.read_range(self.pos, size) if size else b''
+        self.window_start = self.pos
+
+    def _take(self, size):
+        self._fetch(size, self.gap)
+        start = self.pos - self.window_start
+        return self.window[start:start + size]
+
+    def _skip(self, size):
+        pass
+
+    def expect(self, size):
+        self._fetch(size, self.gap)
+
+    def skip_sub_blocks(self, keep=True):
+        """
+        Move past a chain of sub-blocks (including the terminator)
+
+        The contents are only read if keep is set.
+        """
+        if keep:
+            super(RangeReader, self).skip_sub_blocks(keep)
+            return
+        while True:
+            block_size = self.read_byte('The Block is too short to be valid')
+            # Length zero block signals the end of the data
+            if block_size == 0:
+                break
+            self.pos += block_size
+            self.skipped = True
+            if self.size is not None and self.pos > self.size:
+                raise RuntimeError('The Block is shorter than specified')
+            # A full sub-block is most likely followed by another one to skip,
+            # so only the size of that is worth fetching
+            if block_size == 255:
+                self._fetch(1, 0)
+
+    def skip_rest(self, keep=True):
+        """
+        Move past everything left in the file
+
+        The contents are only read if keep is set.
+        """
+        if keep:
+            if self.size is not None:
+                self.read(self.size - self.pos, 'The input file ended unexpectedly')
+                return
+            # Without a known size, keep fetching until the source runs dry
+            while True:
+                data = self.source.read_range(self.pos, CHUNK_SIZE)
+                self.element += data
+                self.pos += len(data)
+                if len(data) < CHUNK_SIZE:
+                    break
+        elif self.size is not None:
+            self.pos = self.size
+            self.skipped = True
+        else:
+            self.skipped = True
+
+class FileRangeSource(object):
+    """
+    A range-addressable source backed by a local file
+
+    Stands in for remote storage (e.g. a blob store billed per byte fetched),
+    and keeps count of what was fetched from it. gap is handed on to the
+    RangeReader (see there).
+    """
+
+    def __init__(self, path, gap=RANGE_GAP):
+        super(FileRangeSource, self).__init__()
+        self.path = path
+        self.gap = gap
+        self.size = os.path.getsize(path)
+        self.bytes_fetched = 0
+        self.requests = 0
+
+    def read_range(self, offset, length):
+        """
+        Read (up to) length bytes starting at offset
+        """
+        with open(self.path, 'rb') as in_f:
+            data = os.pread(in_f.fileno(), length, offset)
+        self.bytes_fetched += len(data)
+        self.requests += 1
+        return data
+
+    def report(self):
+        """
+        Summarize how much of the file was fetched
+        """
+        return f'Fetched {self.bytes_fetched}/{self.size} bytes in {self.requests} requests'
+
+def open_reader(in_f, extracting=False):
+    """
+    Get the best available reader for the input file
+
+    A mapping is preferred either way, since walking it touches only the bytes
+    that are looked at and copies none of them. Input that is already in
+    memory is walked in place for the same reason.
+    """
+    if isinstance(in_f, (bytes, bytearray, memoryview)):
+        return BufferReader(in_f)
+    try:
+        return MappedReader(in_f)
+    except (AttributeError, OSError, ValueError):
+        # Not a regular file (or an empty one), so fall back to reading chunks
+        # or, if nothing has to be copied, to seeking over what isn't needed
+        if extracting and in_f.seekable():
+            return SeekReader(in_f)
+        return Reader(in_f)
+
+# The structure index consulted for inputs given as paths (see structure_index.py)
+structure_index = None
+
+def use_structure_index(index):
+    """
+    Consult index (a StructureIndex, or None for none) for every input given as a path
+    """
+    global structure_index
+    structure_index = index
+
+def open_events(in_path, in_f, handler=None, extracting=False):
+    """
+    Get the reader for the input, and the events parsed from it
+
+    Where the input is a mapped file given as a path and the structure index
+    has an up to date entry for it, the events come straight from the index
+    rather than from walking the file again. Otherwise the walk is recorded in
+    the index for next time.
+    """
+    reader = open_reader(in_f, extracting)
+    if structure_index is None or not isinstance(in_path, (str, os.PathLike)) or not isinstance(reader, MappedReader):
+        return reader, parse(reader, handler)
+    return reader, structure_index.events(in_path, os.fstat(in_f.fileno()), reader.buf,
+                                          lambda: parse(reader, handler))
+
+def parse(reader, handler=None):
+    """
+    Parse a GIF file, yielding one event per element
+
+    If a Handler is given, readers that can skip data (see SeekReader) only
+    read the Extension Blocks and trailing data it asks for. The data of the
+    skipped elements is None.
+
+    The parser calls expect on the reader whenever it knows which bytes it
+    will need next, so readers where each read is costly can combine them.
+    """
+    extension_labels = handler.extension_labels if handler is not None else None
+    wants_trailing = handler.wants_trailing if handler is not None else True
+    wants_color_tables = handler.wants_color_tables if handler is not None else True
+
+    # First the Header (and the Logical Screen Descriptor after it)
+    offset = reader.mark()
+    reader.expect(13)
+    header = reader.read(6, 'The Header is too short to be valid')
+    signature, version = struct.unpack('<3s3s', header)
+    if signature != b'GIF':
+        raise RuntimeError('The signature does not match the GIF specification')
+    yield Header(offset, reader.since_mark(), signature, version)
+
+    # Next the Logical Screen Descriptor
+    offset = reader.mark()
+    reader.read(7, 'The Logical Screen Descriptor is too short to be valid')
+    screen_descriptor = screen_descriptor_event(offset, reader.since_mark())
+    yield screen_descriptor
+
+    # Then the Global Color Table (if present)
+    if screen_descriptor.has_ct:
+        offset = reader.mark()
+        gct_size = color_table_size(screen_descriptor.ct_size)
+        if wants_color_tables:
+            # The table and the type of the first block after it
+            reader.expect(gct_size + 1)
+        reader.skip(gct_size, wants_color_tables, 'The Global Color Table is shorter than specified')
+        yield ColorTable(offset, reader.since_mark(), True)
+
+    # Loop over the rest of the blocks in the image
+    while True:
+        # Read a byte to determine the block type
+        offset = reader.mark()
+        byte = reader.read_byte('Expected more data when there was none')
+
+        if byte == 0x2C:
+            # Image Descriptor
+            reader.expect(9)
+            reader.read(9, 'The Image Descriptor is too short to be valid')
+            image_descriptor = image_descriptor_event(offset, reader.since_mark())
+            yield image_descriptor
+
+            # Then the Local Color Table (if present), along with the LZW
+            # Minimum Code Size and the size of the first sub-block
+            if image_descriptor.has_ct:
+                offset = reader.mark()
+                lct_size = color_table_size(image_descriptor.ct_size)
+                if wants_color_tables:
+                    reader.expect(lct_size + 2)
+                reader.skip(lct_size, wants_color_tables, 'The Local Color Table is shorter than specified')
+                yield ColorTable(offset, reader.since_mark(), False)
+            reader.expect(2)
+
+            # Then the Table Based Image Data
+            offset = reader.mark()
+            lzw_min_size = reader.read_byte('No LZW Minimum Code Size value')
+            reader.skip_sub_blocks(handler is None)
+            yield ImageData(offset, reader.since_mark(), lzw_min_size)
+        elif byte == 0x21:
+            # Extension Block (the label and the size of the first sub-block)
+            reader.expect(2)
+            block_label = reader.read_byte('No Extension Block label')
+            reader.skip_sub_blocks(extension_labels is None or block_label in extension_labels)
+
+            # Just as a reference
+            #   F9 = Graphic Control
+            #   FE = Comment
+            #   01 = Plain Text
+            #   FF = Application
+            #   99 = Our Custom Extension Block Type
+            yield Extension(offset, reader.since_mark(), block_label)
+        elif byte == 0x3B:
+            # Trailer
+            yield Trailer(offset, reader.since_mark())
+            break
+        else:
+            raise RuntimeError(f'Unexpected byte {hex(byte)} found while decoding')
+
+    # Anything after the Trailer is not part of the GIF
+    offset = reader.mark()
+    reader.skip_rest(wants_trailing)
+    yield Trailing(offset, reader.since_mark())
+
+class Handler(object):
+    """
+    The base class for a steganography method
+
+    Each method is called with the matching event and returns the bytes to
+    write in its place, or None to leave the element untouched. The defaults
+    leave everything untouched.
+
+    When extracting, only the Color Tables (unless wants_color_tables is
+    unset) are always read. The contents of Extension Blocks with labels in
+    extension_labels and the trailing data (if wants_trailing is set) are read
+    too, and everything else is skipped.
+    """
+
+    extension_labels = ()
+    wants_trailing = False
+    wants_color_tables = True
+
+    def header(self, event):
+        return None
+
+    def screen_descriptor(self, event):
+        return None
+
+    def color_table(self, event):
+        return None
+
+    def image_descriptor(self, event):
+        return None
+
+    def image_data(self, event):
+        return None
+
+    def extension(self, event):
+        return None
+
+    def trailer(self, event):
+        return None
+
+    def trailing(self, event):
+        return None
+
+    def result(self):
+        """
+        The value returned from run once the whole file has been handled
+        """
+        return None
+
+# Which Handler method handles which event
+DISPATCH = {
+    Header: 'header',
+    ScreenDescriptor: 'screen_descriptor',
+    ColorTable: 'color_table',
+    ImageDescriptor: 'image_descriptor',
+    ImageData: 'image_data',
+    Extension: 'extension',
+    Trailer: 'trailer',
+    Trailing: 'trailing',
+}
+
+# How many bytes of output to gather up before writing them
+OUTPUT_BUFFER_SIZE = 1 << 16
+
+# Untouched elements smaller than this are written from the buffer rather
+# than costing a copy call of their own
+MIN_COPY_SIZE = 4096
+
+# The most pieces to hand to a single writev call (IOV_MAX on Linux)
+WRITEV_MAX = 1024
+
+# The ways of copying between files, in order of preference
+MECHANISMS = [name for name in ('copy_file_range', 'sendfile') if hasattr(os, name)] + [None]
+
+def writable_fd(out_f):
+    """
+    The file descriptor behind out_f, if it is safe to write to directly
+
+    Only regular files and pipes in blocking mode qualify. Anything else (a
+    socket with a timeout, which is non-blocking underneath, say) has to be
+    written through its file object, which knows how to wait for it.
+    """
+    fd = out_f.fileno()
+    mode = os.fstat(fd).st_mode
+    if not (stat.S_ISREG(mode) or stat.S_ISFIFO(mode)):
+        return None
+    if hasattr(os, 'get_blocking') and not os.get_blocking(fd):
+        return None
+    return fd
+
+class Output(object):
+    """
+    The output side of a run
+
+    Elements a Handler left untouched are collected into contiguous ranges of
+    the input file and copied across with copy_file_range (or sendfile) when
+    the input is a real file and the output a real file or blocking pipe, so
+    they never pass through Python. Everything else (new bytes, and untouched
+    elements too small to be worth a copy) is gathered into a reusable buffer
+    and written out flush_size bytes or more at a time, with large pieces
+    written alongside the buffer in a single writev rather than being copied
+    into it.
+    """
+
+    def __init__(self, out_f, in_f, flush_size=OUTPUT_BUFFER_SIZE):
+        super(Output, self).__init__()
+        self.out_f = out_f
+        self.flush_size = flush_size
+        self.in_fd = None
+        self.out_fd = None
+        try:
+            self.out_fd = writable_fd(out_f)
+            if self.out_fd is not None:
+                # Anything the caller already wrote has to land first
+                out_f.flush()
+                # The input has to be a file that can be read at any offset
+                # (not a pipe, say) for ranges of it to be copied after the fact
+                if in_f.seekable():
+                    self.in_fd = in_f.fileno()
+        except (AttributeError, OSError):
+            pass
+        self.mechanism = MECHANISMS[0]
+        # The range of the input waiting to be copied
+        self.start = 0
+        self.end = 0
+        # The bytes waiting to be written (only one of these and the range
+        # is ever waiting at a time, so the order is kept)
+        self.buf = bytearray()
+
+    def keep(self, event):
+        """
+        Pass an element through untouched
+        """
+        if self.start != self.end and event.offset == self.end:
+            # Carries straight on from the range waiting to be copied
+            self.end += len(event.data)
+        elif self.in_fd is None or self.out_fd is None or len(event.data) < MIN_COPY_SIZE:
+            self.write(event.data)
+        else:
+            self.flush()
+            self.start = event.offset
+            self.end = event.offset + len(event.data)
+
+    def write(self, data):
+        """
+        Write new bytes to the output
+        """
+        if self.start != self.end:
+            self.flush()
+        if len(self.buf) + len(data) < self.flush_size:
+            self.buf += data
+        else:
+            # Big enough to go out now, without copying it into the buffer first
+            self.emit([self.buf, data])
+            del self.buf[:]
+
+    def emit(self, pieces):
+        """
+        Write out pieces of data, in order
+        """
+        if self.out_fd is None:
+            for piece in pieces:
+                with memoryview(piece) as view:
+                    pos = 0
+                    while pos < len(view):
+                        # A raw file object may take only part of it
+                        written = self.out_f.write(view[pos:])
+                        if written is None:
+                            raise BlockingIOError('The output would block')
+                        pos += written
+            return
+        views = [memoryview(piece) for piece in pieces if len(piece)]
+        while views:
+            if hasattr(os, 'writev'):
+                written = os.writev(self.out_fd, views[:WRITEV_MAX])
+            else:
+                written = os.write(self.out_fd, views[0])
+            # Drop whatever went out, which may have stopped part way through a piece
+            while views and written >= len(views[0]):
+                written -= len(views[0])
+                views.pop(0)
+            if written:
+                views[0] = views[0][written:]
+
+    def flush(self):
+        """
+        Write out whatever is waiting (a range of the input, or the buffer)
+        """
+        if self.buf:
+            self.emit([self.buf])
+            del self.buf[:]
+        if self.start == self.end:
+            return
+        offset, count = self.start, self.end - self.start
+        self.start = self.end
+        while count:
+            copied = self.copy(offset, count)
+            if copied == 0:
+                raise RuntimeError('The input file ended unexpectedly')
+            offset += copied
+            count -= copied
+
+    def copy(self, offset, count):
+        """
+        Copy up to count bytes from offset in the input to the output
+
+        Tries the cheapest mechanism first and remembers which one works.
+        """
+        while True:
+            try:
+                if self.mechanism == 'copy_file_range':
+                    return os.copy_file_range(self.in_fd, self.out_fd, count, offset)
+                elif self.mechanism == 'sendfile':
+                    return os.sendfile(self.out_fd, self.in_fd, offset, count)
+                else:
+                    return os.write(self.out_fd, os.pread(self.in_fd, min(count, CHUNK_SIZE), offset))
+            except OSError:
+                if self.mechanism is None:
+                    raise
+            # Not supported for these files, so fall back to the next mechanism
+            self.mechanism = MECHANISMS[MECHANISMS.index(self.mechanism) + 1]
+
+class StatsOutput(Output):
+    """
+    An Output that records its time and copies in a Stats (see stats.py)
+    """
+
+    def __init__(self, out_f, in_f, stats):
+        super(StatsOutput, self).__init__(out_f, in_f)
+        self.stats = stats
+        stats.info['copy'] = 'none' if self.in_fd is None or self.out_fd is None else 'by range'
+
+    def emit(self, pieces):
+        self.stats.timed('output', super(StatsOutput, self).emit, pieces)
+        self.stats.count('write_calls')
+        self.stats.count('write_bytes', sum(len(piece) for piece in pieces))
+
+    def copy(self, offset, count):
+        copied = self.stats.timed('output', super(StatsOutput, self).copy, offset, count)
+        self.stats.count('copy_calls')
+        self.stats.count('copy_bytes', copied)
+        self.stats.info['copy'] = self.mechanism or 'pread/write'
+        return copied
+
+def extract(reader, handler, stats=None, events=None):
+    """
+    Feed every element the handler needs through it, without writing anything
+
+    The events are parsed from reader, unless they are given.
+    """
+    try:
+        if events is None:
+            events = parse(reader, handler)
+        if stats is not None:
+            stats.info['reader'] = type(reader).__name__
+            events = stats.timed_events(events)
+        for event in events:
+            getattr(handler, DISPATCH[type(event)])(event)
+        return handler.result()
+    finally:
+        # Drop our hold on the last event so the mapping can be released
+        event = None
+        reader.close()
+
+def open_file(target, mode, stack):
+    """
+    Get a binary file object for an input or output
+
+    Paths are opened (and closed again when stack is), sockets are wrapped in
+    a file object, bytes-like objects (as inputs) and file objects are used as
+    they are.
+    """
+    if isinstance(target, (str, os.PathLike)):
+        return stack.enter_context(open(target, mode))
+    if hasattr(target, 'makefile'):
+        return stack.enter_context(target.makefile(mode))
+    return target
+
+def run(in_path, out_path, handler, stats=None):
+    """
+    Feed every element of the input file through handler, writing the output (if any)
+
+    The input may be a path, a bytes-like object or a readable binary file
+    object (or socket), and the output a path or a writable one. When
+    extracting, the input may also be a range-addressable source (see
+    RangeReader).
+
+    If stats is given, the run is instrumented and stats is called with a
+    report of where the time went (see stats.py) once it is over.
+    """
+    if stats is None:
+        return feed(in_path, out_path, handler)
+
+    recorder = Stats()
+    wall, cpu = time.perf_counter(), time.thread_time()
+    try:
+        return feed(in_path, out_path, TimedHandler(handler, recorder), recorder)
+    finally:
+        recorder.add('total', time.perf_counter() - wall, time.thread_time() - cpu)
+        stats(recorder.report())
+
+def feed(in_path, out_path, handler, stats=None):
+    """
+    The body of run, recording into stats (a Stats) if given
+    """
+    if hasattr(in_path, 'read_range'):
+        if out_path is not None:
+            raise RuntimeError('Data can only be extracted from a range-addressable source')
+        return extract(RangeReader(in_path), handler, stats)
+
+    with ExitStack() as stack:
+        in_f = open_file(in_path, 'rb', stack)
+        if stats is not None and not isinstance(in_f, (bytes, bytearray, memoryview)):
+            in_f = CountingFile(in_f, stats)
+        if out_path is None:
+            # Extracting, so there is nothing to copy and only the parts the
+            # handler needs have to be read at all
+            reader, events = open_events(in_path, in_f, handler, True)
+            return extract(reader, handler, stats, events)
+
+        out_f = open_file(out_path, 'wb', stack)
+        reader, events = open_events(in_path, in_f)
+        try:
+            if stats is None:
+                out = Output(out_f, in_f)
+            else:
+                out = StatsOutput(out_f, in_f, stats)
+                stats.info['reader'] = type(reader).__name__
+                events = stats.timed_events(events)
+            for event in events:
+                data = getattr(handler, DISPATCH[type(event)])(event)
+                if data is None:
+                    out.keep(event)
+                else:
+                    out.write(data)
+            out.flush()
+            result = handler.result()
+        finally:
+            # Drop our hold on the last event so the mapping can be released
+            event = None
+            reader.close()
+    return result
+
+def run_to_bytes(in_path, out_path, handler, stats=None):
+    """
+    Like run, but with no output given the output is returned as bytes instead
+    """
+    if out_path is not None:
+        run(in_path, out_path, handler, stats)
+        return None
+    out_f = io.BytesIO()
+    run(in_path, out_f, handler, stats)
+    return out_f.getvalue()
+
+def rereadable(in_path):
+    """
+    Make an input that will be run over more than once safe to do so
+
+    Paths, bytes-like objects and range-addressable sources can be read any
+    number of times, but a file object is read to the end the first time, so
+    its contents are pulled into memory.
+    """
+    if isinstance(in_path, (str, os.PathLike, bytes, bytearray, memoryview)) or hasattr(in_path, 'read_range'):
+        return in_path
+    with ExitStack() as stack:
+        return open_file(in_path, 'rb', stack).read()
@@ -5,7 +5,14 @@ The main program used to hide data in a GIF
 """
 
 import argparse
+import json
 import os.path
+import sys
+import time
+
+import batch
+import compression
+import session
 
 def main():
     """
@@ -17,7 +24,7 @@ def main():
 
     # Set up the argument parser
     parser = argparse.ArgumentParser(description='Hide data in/extract data from a GIF.')
-    group = parser.add_mutually_exclusive_group(required=True)
+    group = parser.add_mutually_exclusive_group()
     group.add_argument('-a', '--append', action='store_true',
                        help='Data goes after the GIF trailer')
     group.add_argument('-c', '--comment', action='store_true',
@@ -28,18 +35,89 @@ def main():
                        help='Data goes in the Least Significant Bits of the Color Table entries')
     group.add_argument('-s', '--shuffle', action='store_true',
                        help='Data goes into a permutation of the Color Table entries')
+    group.add_argument('--auto', action='store_true',
+                       help='Data goes wherever is cheapest for the file and payload (when hiding only)')
+    parser.add_argument('-b', '--bits', type=int, choices=range(1, 5),
+                        help='With --lsb, use this many low bits of each Color Table entry, packed continuously')
+    parser.add_argument('--striped', action='store_true',
+                        help='With --shuffle, split the data across all the Color Tables rather than copying it into each')
+    parser.add_argument('--stealth', type=int, choices=range(0, 5), default=0,
+                        help='With --auto, only use methods at least this hard to spot (0: append, 1: comment, '
+                             '2: extension, 3: lsb, 4: shuffle)')
+    parser.add_argument('-z', dest='compress', action='store_const', const='auto',
+                        help='Compress the data with whichever codec suits it best (same as --compress auto)')
+    parser.add_argument('--compress', choices=('auto',) + compression.available(),
+                        help='Compress the data with this codec before hiding it (when extracting, any codec '
+                             'undoes the compression, whichever codec was used)')
+    parser.add_argument('--level', type=int, choices=range(0, 10),
+                        help='With --compress, the compression level')
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='With several input files, the number of worker processes to use (default: one per CPU)')
+    parser.add_argument('--chunksize', type=int,
+                        help='With several input files, the number of files to hand a worker at a time')
+    parser.add_argument('--summary',
+                        help='With several input files, write the JSONL summary here rather than to stdout')
+    parser.add_argument('--index-cache', metavar='FILE',
+                        help='Keep the structure of the input files here, so reusing them skips most of the parsing')
+    parser.add_argument('--stats', action='store_true',
+                        help='Write a JSON report of where the time went to stderr')
+    parser.add_argument('--stats-file', metavar='FILE',
+                        help='With --stats, write the report here instead')
     subparsers = parser.add_subparsers(help='Whether to hide or extract data', dest='action')
 
     # Subparser for hiding data
     subparser = subparsers.add_parser('hide')
     subparser.add_argument('payload',
                            help='The data to hide')
-    subparser.add_argument('in_file', help='The input file')
-    subparser.add_argument('out_file', help='The output file')
+    subparser.add_argument('in_file', nargs='+',
+                           help='The input file, - for stdin (or several, as files, globs or directories)')
+    subparser.add_argument('out_file',
+                           help='The output file, - for stdout (or the output directory, for several input files)')
 
     # Subparser for extracting data
     subparser = subparsers.add_parser('extract')
-    subparser.add_argument('in_file', help='The input file')
+    subparser.add_argument('in_file', nargs='+',
+                           help='The input file, - for stdin (or several, as files, globs or directories)')
+
+    # Subparser for a batch of files listed in a manifest
+    subparser = subparsers.add_parser('manifest')
+    subparser.add_argument('manifest_file',
+                           help='CSV rows of payload,in_file,out_file to hide data or in_file to extract it')
+
+    # Subparsers for spreading data too big for any one file across several
+    subparser = subparsers.add_parser('shard')
+    subparser.add_argument('payload_file',
+                           help='The file holding the data to hide, - for stdin')
+    subparser.add_argument('in_file', nargs='+',
+                           help='The input files, used in order until the data runs out (as files, globs or directories)')
+    subparser.add_argument('out_dir',
+                           help='The output directory')
+    subparser = subparsers.add_parser('unshard')
+    subparser.add_argument('in_file', nargs='+',
+                           help='The files holding the chunks, in any order (as files, globs or directories)')
+    subparser.add_argument('-o', '--out-file',
+                           help='Write the data here rather than to stdout')
+
+    # Subparser for reporting how much data files can hold
+    subparser = subparsers.add_parser('capacity')
+    subparser.add_argument('in_file', nargs='+',
+                           help='The files to report on (as files, globs or directories)')
+    subparser.add_argument('--cache',
+                           help='Cache the report here (default: .gifsteg-capacity.json in the directory, '
+                                'when a single directory is given)')
+    subparser.add_argument('--no-cache', action='store_true',
+                           help='Neither read nor write a cache')
+
+    # Subparser for running the HTTP service
+    subparser = subparsers.add_parser('serve')
+    subparser.add_argument('--host', default='127.0.0.1',
+                           help='The address to listen on (default: %(default)s)')
+    subparser.add_argument('--port', type=int, default=8080,
+                           help='The port to listen on (default: %(default)s)')
+    subparser.add_argument('--workers', type=int,
+                           help='The number of worker threads')
+    subparser.add_argument('-v', '--verbose', action='store_true',
+                           help='Log every request')
 
     # Actually parse the arguments
     args = parser.parse_args()
@@ -47,40 +125,159 @@ def main():
         parser.print_help()
         return 2
 
-    # Determine the module to use
-    if args.append:
-        import append
-        module = append
-    elif args.comment:
-        import comment
-        module = comment
-    elif args.extension:
-        import extension
-        module = extension
-    elif args.lsb:
-        import lsb
-        module = lsb
-    elif args.shuffle:
-        import shuffle
-        module = shuffle
+    # The service takes the method with each request
+    if args.action == 'serve':
+        import server
+        server.serve(args.host, args.port, args.workers, args.verbose)
+        return 0
+
+    # Remember the structure of the carriers from one run to the next
+    if args.index_cache is not None:
+        import structure_index
+        structure_index.install(args.index_cache)
+
+    # Determine the method to use (a capacity report covers them all anyway)
+    for method in session.METHODS + ('auto',):
+        if getattr(args, method):
+            break
     else:
-        raise RuntimeError('No steganography method selected')
-   
+        if args.action != 'capacity':
+            parser.error('one of the arguments -a/--append -c/--comment -e/--extension -l/--lsb -s/--shuffle '
+                         '--auto is required')
+        method = None
+    if method == 'auto' and args.action not in ('hide', 'manifest'):
+        parser.error('--auto can only be used to hide data')
+
+    # Options only some methods take
+    kwargs = {}
+    if args.bits is not None:
+        if not args.lsb:
+            parser.error('--bits can only be used with --lsb')
+        kwargs['bits'] = args.bits
+    if args.striped:
+        if not args.shuffle:
+            parser.error('--striped can only be used with --shuffle')
+        kwargs['striped'] = True
+    if args.stealth:
+        if not args.auto:
+            parser.error('--stealth can only be used with --auto')
+        kwargs['stealth'] = args.stealth
+    if args.level is not None and args.compress is None:
+        parser.error('--level can only be used with --compress')
+    if args.compress is not None:
+        kwargs['compress'] = args.compress
+        kwargs['level'] = args.level
+
+    # The capacity report, sorted by the chosen method (if any)
+    if args.action == 'capacity':
+        import capacity
+        cache_path = args.cache
+        if cache_path is None and len(args.in_file) == 1 and os.path.isdir(args.in_file[0]):
+            cache_path = os.path.join(args.in_file[0], capacity.CACHE_FILE)
+        sort_by = capacity.variant_name(method, kwargs) if method is not None else 'lsb'
+        entries = capacity.report(args.in_file, sort_by, None if args.no_cache else cache_path, args.jobs or 1)
+        for entry in entries:
+            print(json.dumps(entry))
+        return 0
+
+    # Several files at once go through the worker pool
+    if args.stats_file is not None and not args.stats:
+        parser.error('--stats-file can only be used with --stats')
+    if args.stats and (args.action in ('manifest', 'shard', 'unshard') or batch.is_batch(args.in_file)):
+        parser.error('--stats can only be used with a single input file')
+    if args.action == 'shard':
+        import shard
+        if args.payload_file == '-':
+            data = sys.stdin.buffer.read()
+        else:
+            with open(args.payload_file, 'rb') as payload_f:
+                data = payload_f.read()
+        return run_batch(shard.hide_tasks(method, data, args.in_file, args.out_dir, kwargs), args)
+    if args.action == 'unshard':
+        import shard
+        if args.out_file is None:
+            summary = shard.reassemble(method, args.in_file, sys.stdout.buffer, kwargs, args.jobs)
+        else:
+            with open(args.out_file, 'wb') as out_f:
+                summary = shard.reassemble(method, args.in_file, out_f, kwargs, args.jobs)
+        print(json.dumps(summary), file=sys.stderr)
+        return 0
+    if args.action == 'manifest':
+        return run_batch(batch.read_manifest(method, args.manifest_file, kwargs), args)
+    if batch.is_batch(args.in_file):
+        if args.action == 'hide':
+            tasks = batch.hide_tasks(method, args.payload.encode('utf-8'), args.in_file, args.out_file, kwargs)
+        else:
+            tasks = batch.extract_tasks(method, args.in_file, kwargs)
+        return run_batch(tasks, args)
+    args.in_file = args.in_file[0]
+
+    # - stands for stdin/stdout, so the tool can sit in a pipeline
+    in_file = sys.stdin.buffer if args.in_file == '-' else args.in_file
+
+    # Collect a report from each pass over the input
+    reports = []
+    if args.stats:
+        kwargs['stats'] = reports.append
+
     # Invoke the relevant algorithm
     if args.action == 'hide':
-        # Make sure the output directory exists
-        out_dir = os.path.dirname(args.out_file)
-        if out_dir and not os.path.exists(out_dir):
-            os.makedirs(out_dir)
-        # Call the chosen steg function, passing input, output, and payload to cause hiding
-        module.steg(args.in_file, args.out_file, args.payload.encode('utf-8'))
+        if args.out_file == '-':
+            out_file = sys.stdout.buffer
+        else:
+            # Make sure the output directory exists
+            out_file = args.out_file
+            out_dir = os.path.dirname(out_file)
+            if out_dir and not os.path.exists(out_dir):
+                os.makedirs(out_dir)
+        if method == 'auto':
+            # Let the payload and file decide, then say what was decided (for
+            # extracting it again)
+            import auto
+            choice, _ = auto.hide(in_file, args.payload.encode('utf-8'), out_file, **kwargs)
+            method = choice.method
+            print(json.dumps({'method': choice.method, 'options': choice.options, 'capacity': choice.capacity,
+                              'estimated_seconds': round(choice.cost, 6)}), file=sys.stderr)
+        else:
+            # Call the chosen steg function, passing input, output, and payload to cause hiding
+            session.Session(method, **kwargs).steg(in_file, out_file, args.payload.encode('utf-8'))
     elif args.action == 'extract':
         # Call the chosen steg function, passing only input to cause extraction
-        data = module.steg(args.in_file)
-        print(data.decode('utf-8'))
+        data = session.Session(method, **kwargs).steg(in_file)
+        # Write the data out exactly as it was hidden (with a newline for the
+        # benefit of a terminal only)
+        sys.stdout.buffer.write(data)
+        if sys.stdout.isatty():
+            sys.stdout.buffer.write(b'\n')
+
+    if args.stats:
+        report = json.dumps({'method': method, 'action': args.action, 'runs': reports}, indent=2)
+        if args.stats_file is None:
+            print(report, file=sys.stderr)
+        else:
+            with open(args.stats_file, 'w', encoding='utf-8') as stats_f:
+                stats_f.write(report + '\n')
 
     return 0
 
+def run_batch(tasks, args):
+    """
+    Run a batch of tasks, writing a JSONL summary line per file
+
+    Returns the exit status: 0 if every file succeeded, 1 otherwise.
+    """
+    summary_f = open(args.summary, 'w', encoding='utf-8') if args.summary else sys.stdout
+    start = time.perf_counter()
+    failed = 0
+    try:
+        for result in batch.run_batch(tasks, args.jobs, args.chunksize, args.index_cache):
+            failed += not result['ok']
+            summary_f.write(json.dumps(result) + '\n')
+    finally:
+        if summary_f is not sys.stdout:
+            summary_f.close()
+    print(f'{len(tasks)} files, {failed} failed, in {time.perf_counter() - start:.3f}s', file=sys.stderr)
+    return 1 if failed else 0
 
 # Run the main function if loaded directly
 if __name__ == '__main__':
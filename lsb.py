@@ -2,204 +2,306 @@
 The LSB implementation of the GIF steganography suite
 """
 
-from maybe_open import maybe_open
+from gif_parser import Handler, color_table_size, rereadable, run, run_to_bytes
 import struct
 
-all_data = bytearray()
+try:
+    import numpy
+except ImportError:
+    # NumPy is optional, the pure Python loops below are used without it
+    numpy = None
 
-def copy_blocks(in_f, out_f):
+def unpack_bytes(ct, num_bytes):
     """
-    Copy through blocks of data
+    Read num_bytes bytes out of the LSBs of the color table
     """
-    while True:
-        # Read the block size
-        block_size = in_f.read(1)
-        if len(block_size) != 1:
-            raise RuntimeError('The Block is too short to be valid')
-        block_size, = struct.unpack('<B', block_size)
+    if numpy is not None:
+        # Gather the LSBs of the first num_bytes * 8 entries and pack them MSB first
+        bits = numpy.frombuffer(ct, dtype=numpy.uint8, count=num_bytes * 8) & 0b00000001
+        return numpy.packbits(bits).tobytes()
 
-        # Read the data in the block
-        block_data = in_f.read(block_size)
-        if len(block_data) != block_size:
-            raise RuntimeError('The Block is shorter than specified')
+    data = bytearray()
+    for index in range(num_bytes):
+        byte = 0
+        byte |= (ct[index * 8 + 0] & 0b00000001) << 7
+        byte |= (ct[index * 8 + 1] & 0b00000001) << 6
+        byte |= (ct[index * 8 + 2] & 0b00000001) << 5
+        byte |= (ct[index * 8 + 3] & 0b00000001) << 4
+        byte |= (ct[index * 8 + 4] & 0b00000001) << 3
+        byte |= (ct[index * 8 + 5] & 0b00000001) << 2
+        byte |= (ct[index * 8 + 6] & 0b00000001) << 1
+        byte |= (ct[index * 8 + 7] & 0b00000001) << 0
+        data.append(byte)
+    return data
 
-        # Write the size and data to the output
-        out_f.write(bytes([block_size]))
-        out_f.write(block_data)
+def pack_bytes(ct, data):
+    """
+    Write data into the LSBs of the color table, returning the new color table
+    """
+    if numpy is not None:
+        # Spread the data out one bit (MSB first) per entry and swap in the LSBs
+        ct = numpy.frombuffer(ct, dtype=numpy.uint8).copy()
+        bits = numpy.unpackbits(numpy.frombuffer(bytes(data), dtype=numpy.uint8))
+        ct[:len(bits)] = (ct[:len(bits)] & 0b11111110) | bits
+        return bytearray(ct.tobytes())
 
-        # Length zero block signals the end of the data
-        if block_size == 0:
-            break
+    ct = bytearray(ct)
+    for index, byte in enumerate(data):
+        ct[index * 8 + 0] = (ct[index * 8 + 0] & 0b11111110) | ((byte & 0b10000000) >> 7)
+        ct[index * 8 + 1] = (ct[index * 8 + 1] & 0b11111110) | ((byte & 0b01000000) >> 6)
+        ct[index * 8 + 2] = (ct[index * 8 + 2] & 0b11111110) | ((byte & 0b00100000) >> 5)
+        ct[index * 8 + 3] = (ct[index * 8 + 3] & 0b11111110) | ((byte & 0b00010000) >> 4)
+        ct[index * 8 + 4] = (ct[index * 8 + 4] & 0b11111110) | ((byte & 0b00001000) >> 3)
+        ct[index * 8 + 5] = (ct[index * 8 + 5] & 0b11111110) | ((byte & 0b00000100) >> 2)
+        ct[index * 8 + 6] = (ct[index * 8 + 6] & 0b11111110) | ((byte & 0b00000010) >> 1)
+        ct[index * 8 + 7] = (ct[index * 8 + 7] & 0b11111110) | ((byte & 0b00000001) >> 0)
+    return ct
 
-def extract_data(in_f, has_ct, ct_size):
+def extract_data(ct, all_data):
     """
     Extract the data from the color table and add it to all_data
     """
-    global all_data
-    if has_ct:
-        true_ct_size = 3 * (2 ** (ct_size + 1))
-        ct = bytearray(in_f.read(true_ct_size))
-        if len(ct) != true_ct_size:
-            raise RuntimeError('The Color Table is shorter than specified')
-
-        # Extract as much data into the Color Table as possible
-        # Use only one-byte chunks to avoid complication, so a 15 byte color table will
-        # contain one byte of data across the first 8 bytes and no data in the last 7
-        num_bytes = true_ct_size // 8
-        for index in range(num_bytes):
-            byte = 0
-            byte |= (ct[index * 8 + 0] & 0b00000001) << 7
-            byte |= (ct[index * 8 + 1] & 0b00000001) << 6
-            byte |= (ct[index * 8 + 2] & 0b00000001) << 5
-            byte |= (ct[index * 8 + 3] & 0b00000001) << 4
-            byte |= (ct[index * 8 + 4] & 0b00000001) << 3
-            byte |= (ct[index * 8 + 5] & 0b00000001) << 2
-            byte |= (ct[index * 8 + 6] & 0b00000001) << 1
-            byte |= (ct[index * 8 + 7] & 0b00000001) << 0
-
-            # Add the extracted byte if there is still data remaining
-            if len(all_data) == 0 or len(all_data) <= all_data[0]:
-                all_data.append(byte)
-
-def hide_data(in_f, out_f, has_ct, ct_size, data):
-    """
-    Insert the data into the color table and write to the output file
-    """
-    if has_ct:
-        true_ct_size = 3 * (2 ** (ct_size + 1))
-        ct = bytearray(in_f.read(true_ct_size))
-        if len(ct) != true_ct_size:
-            raise RuntimeError('The Color Table is shorter than specified')
-
-        # Insert as much data into the Color Table as possible
-        # Use only one-byte chunks to avoid complication, so a 15 byte color table will
-        # contain one byte of data across the first 8 bytes and no data in the last 7
-        num_bytes = min(true_ct_size // 8, len(data))
-        for index, byte in enumerate(data[:num_bytes]):
-            ct[index * 8 + 0] = (ct[index * 8 + 0] & 0b11111110) | ((byte & 0b10000000) >> 7)
-            ct[index * 8 + 1] = (ct[index * 8 + 1] & 0b11111110) | ((byte & 0b01000000) >> 6)
-            ct[index * 8 + 2] = (ct[index * 8 + 2] & 0b11111110) | ((byte & 0b00100000) >> 5)
-            ct[index * 8 + 3] = (ct[index * 8 + 3] & 0b11111110) | ((byte & 0b00010000) >> 4)
-            ct[index * 8 + 4] = (ct[index * 8 + 4] & 0b11111110) | ((byte & 0b00001000) >> 3)
-            ct[index * 8 + 5] = (ct[index * 8 + 5] & 0b11111110) | ((byte & 0b00000100) >> 2)
-            ct[index * 8 + 6] = (ct[index * 8 + 6] & 0b11111110) | ((byte & 0b00000010) >> 1)
-            ct[index * 8 + 7] = (ct[index * 8 + 7] & 0b11111110) | ((byte & 0b00000001) >> 0)
-
-        # Write out the modified Color Table
-        out_f.write(ct)
-
-        # Return the number of bytes written into the Color Table
-        return num_bytes
-    else:
-        # No Color Table => No space to hide stuff
-        return 0
-
-def steg(in_path, out_path=None, data=None):
+    # Extract as much data into the Color Table as possible
+    # Use only one-byte chunks to avoid complication, so a 15 byte color table will
+    # contain one byte of data across the first 8 bytes and no data in the last 7
+    num_bytes = len(ct) // 8
+
+    # The first byte is the length of the rest, so once we have that we know
+    # exactly how much more there is to extract
+    if len(all_data) != 0:
+        num_bytes = min(num_bytes, all_data[0] + 1 - len(all_data))
+        if num_bytes <= 0:
+            return
+    all_data += unpack_bytes(ct, num_bytes)
+    if len(all_data) != 0:
+        del all_data[all_data[0] + 1:]
+
+def hide_data(ct, data):
     """
-    The steg function (use the LSB of the color table entries to hide the data)
+    Insert the data into the color table
+
+    Returns the modified Color Table and the number of bytes written into it
+    """
+    # Insert as much data into the Color Table as possible
+    # Use only one-byte chunks to avoid complication, so a 15 byte color table will
+    # contain one byte of data across the first 8 bytes and no data in the last 7
+    num_bytes = min(len(ct) // 8, len(data))
+    return pack_bytes(ct, data[:num_bytes]), num_bytes
+
+class LsbHandler(Handler):
+    """
+    Put the data in the Least Significant Bits of the Color Table entries
+    """
+
+    def __init__(self, data=None):
+        super(LsbHandler, self).__init__()
+        # Must encode the length of the data so we know how much to read when extracting
+        if data is not None:
+            if len(data) > 255:
+                raise RuntimeError(f'Can only hide up to 255 bytes of data (not {len(data)})')
+            data_array = bytearray(data)
+            data_array.insert(0, len(data))
+            data = data_array
+        self.data = data
+        self.bytes_written = 0
+        self.all_data = bytearray()
+
+    def color_table(self, event):
+        if self.data is not None:
+            ct, num_bytes = hide_data(event.data, self.data[self.bytes_written:])
+            self.bytes_written += num_bytes
+            return ct
+        else:
+            extract_data(event.data, self.all_data)
+
+    def result(self):
+        if self.data is not None:
+            # Verify that we wrote all the data
+            if self.bytes_written != len(self.data):
+                raise RuntimeError(f'Failed to hide all the data ({max(0, self.bytes_written - 1)}/{len(self.data) - 1})')
+        else:
+            # If data was None (the extracting case), return all the extracted data
+            # Don't include the hidden length byte...
+            return bytes(self.all_data[1:])
+
+# Translation tables that keep just the low bits of a byte, by number of bits
+LOW_BITS = [bytes(byte & ((1 << bits) - 1) for byte in range(256)) for bits in range(9)]
+
+def pack_bitstream(data, bits):
+    """
+    Split data into a stream of bits-sized values (MSB first), one per color table entry
+
+    The last value is padded with zero bits as needed.
+    """
+    if numpy is not None:
+        stream = numpy.unpackbits(numpy.frombuffer(bytes(data), dtype=numpy.uint8))
+        stream = numpy.concatenate((stream, numpy.zeros(-len(stream) % bits, dtype=numpy.uint8)))
+        # Weight each group of bits to turn it into a value
+        weights = numpy.left_shift(1, numpy.arange(bits - 1, -1, -1)).astype(numpy.uint8)
+        return (stream.reshape(-1, bits) * weights).sum(axis=1, dtype=numpy.uint8).tobytes()
+
+    stream = ''.join(format(byte, '08b') for byte in data)
+    stream += '0' * (-len(stream) % bits)
+    return bytes(int(stream[pos:pos + bits], 2) for pos in range(0, len(stream), bits))
+
+def unpack_bitstream(values, bits, num_bytes):
+    """
+    Join a stream of bits-sized values (MSB first) back into num_bytes bytes of data
+    """
+    if numpy is not None:
+        stream = numpy.unpackbits(numpy.frombuffer(bytes(values), dtype=numpy.uint8).reshape(-1, 1), axis=1)
+        return numpy.packbits(stream[:, 8 - bits:].reshape(-1)[:num_bytes * 8]).tobytes()
+
+    stream = ''.join(format(value, f'0{bits}b') for value in values)[:num_bytes * 8]
+    return int(stream, 2).to_bytes(num_bytes, 'big') if num_bytes else b''
+
+def insert_values(ct, values, bits):
+    """
+    Replace the low bits of the first len(values) color table entries with values
+    """
+    keep = 0xFF & ~((1 << bits) - 1)
+    if numpy is not None:
+        ct = numpy.frombuffer(ct, dtype=numpy.uint8).copy()
+        ct[:len(values)] = (ct[:len(values)] & keep) | numpy.frombuffer(values, dtype=numpy.uint8)
+        return bytearray(ct.tobytes())
+
+    ct = bytearray(ct)
+    for index, value in enumerate(values):
+        ct[index] = (ct[index] & keep) | value
+    return ct
+
+def extract_values(ct, bits):
+    """
+    Get the low bits of every color table entry
+    """
+    return bytes(ct).translate(LOW_BITS[bits])
+
+class BitPlaneHandler(Handler):
+    """
+    Put the data in the low bits (1 to 4 of them) of the Color Table entries
+
+    Unlike LsbHandler, the data is one continuous bitstream running across the
+    Global Color Table and every Local Color Table in turn, so no space is lost
+    to byte alignment within a table. It starts with a 4 byte length.
     """
 
-    # Must encode the length of the data so we know how much to read when extracting
-    if data is not None:
-        data_array = bytearray(data)
-        data_array.insert(0, len(data))
-        data = data_array
-
-    with open(in_path, 'rb') as in_f:
-        with maybe_open(out_path, 'wb') as out_f:
-            # First the Header
-            header = in_f.read(6)
-            if len(header) != 6:
-                raise RuntimeError('The Header is too short to be valid')
-            signature, version = struct.unpack('<3s3s', header)
-            if signature != b'GIF':
-                raise RuntimeError('The signature does not match the GIF specification')
-            out_f.write(header)
-
-            # Next the Logical Screen Descriptor
-            screen_descriptor = in_f.read(7)
-            if len(screen_descriptor) != 7:
-                raise RuntimeError('The Logical Screen Descriptor is too short to be valid')
-            width, heigh, packed, bg_color_index, aspect_ratio = struct.unpack('<2H3B', screen_descriptor)
-            has_gct   = (packed & 0b10000000) >> 7
-            color_res = (packed & 0b01110000) >> 4
-            sort_flag = (packed & 0b00001000) >> 3
-            gct_size  = (packed & 0b00000111) >> 0
-            out_f.write(screen_descriptor)
-
-            # Then the Global Color Table (if present)
-            if data is not None:
-                bytes_written = hide_data(in_f, out_f, has_gct, gct_size, data)
-            else:
-                extract_data(in_f, has_gct, gct_size)
-
-            # Loop over the rest of the blocks in the image
-            while True:
-                # Read a byte to determine the block type
-                field = in_f.read(1)
-                if len(field) != 1:
-                    raise RuntimeError('Expected more data when there was none')
-                byte = field[0]
-
-                if byte == 0x2C:
-                    # Image Descriptor
-                    descriptor = in_f.read(9)
-                    if len(descriptor) != 9:
-                        raise RuntimeError('The Image Descriptor is too short to be valid')
-                    left_pos, top_pos, width, height, packed = struct.unpack('<4HB', descriptor)
-                    has_lct   = (packed & 0b10000000) >> 7
-                    interlace = (packed & 0b01000000) >> 6
-                    sort_flag = (packed & 0b00100000) >> 5
-                    reserved  = (packed & 0b00011000) >> 4
-                    lct_size  = (packed & 0b00000111) >> 0
-                    out_f.write(bytes([byte]))
-                    out_f.write(descriptor)
-
-                    # Then the Local Color Table (if present)
-                    if data is not None:
-                        bytes_written += hide_data(in_f, out_f, has_lct, lct_size, data[bytes_written:])
-                    else:
-                        extract_data(in_f, has_lct, lct_size)
-
-                    # Then the Table Based Image Data
-                    lzw_min_size = in_f.read(1)
-                    if len(lzw_min_size) != 1:
-                        raise RuntimeError('No LZW Minimum Code Size value')
-                    lzw_min_size, = struct.unpack('<B', lzw_min_size)
-                    out_f.write(bytes([lzw_min_size]))
-                    copy_blocks(in_f, out_f)
-                elif byte == 0x21:
-                    # Extension Block
-                    block_label = in_f.read(1)
-                    if len(block_label) != 1:
-                        raise RuntimeError('No Extension Block label')
-                    out_f.write(bytes([byte]))
-                    out_f.write(block_label)
-
-                    # Just as a reference (for our purposes, we can pass these through all the same)
-                    #   F9 = Graphic Control
-                    #   FE = Comment
-                    #   01 = Plain Text
-                    #   FF = Application
-                    #   99 = Our Custom Extension Block Type
-
-                    # Copy the blocks
-                    copy_blocks(in_f, out_f)
-                elif byte == 0x3B:
-                    # Trailer
-                    out_f.write(bytes([byte]))
-                    break
-                else:
-                    raise RuntimeError(f'Unexpected byte {hex(byte)} found while decoding')
-
-            # Politely pass any extra appended data through :)
-            out_f.write(in_f.read())
-
-            if data is not None:
-                # Verify that we wrote all the data
-                if bytes_written != len(data):
-                    raise RuntimeError(f'Failed to hide all the data ({max(0, bytes_written - 1)}/{len(data) - 1})')
-            else:
-                # If data was None (the extracting case), return all the extracted data
-                # Don't include the hidden length byte...
-                return all_data[1:]
+    def __init__(self, data=None, bits=1):
+        super(BitPlaneHandler, self).__init__()
+        if bits not in range(1, 5):
+            raise RuntimeError(f'Can only use between 1 and 4 bits per Color Table entry (not {bits})')
+        self.bits = bits
+        self.data = data
+        if data is not None:
+            self.values = pack_bitstream(struct.pack('>I', len(data)) + bytes(data), bits)
+        else:
+            self.values = bytearray()
+        # Values written so far, or values still needed (unknown until the length is read)
+        self.pos = 0
+        self.needed = None
+
+    def color_table(self, event):
+        if self.data is not None:
+            if self.pos >= len(self.values):
+                return None
+            num_values = min(len(event.data), len(self.values) - self.pos)
+            ct = insert_values(event.data, self.values[self.pos:self.pos + num_values], self.bits)
+            self.pos += num_values
+            return ct
+
+        if self.needed is not None and len(self.values) >= self.needed:
+            return None
+        self.values += extract_values(event.data, self.bits)
+        if self.needed is None and len(self.values) * self.bits >= 32:
+            # Now that the length is known, so is the number of values to read
+            length, = struct.unpack('>I', unpack_bitstream(self.values, self.bits, 4))
+            self.needed = -(-(32 + length * 8) // self.bits)
+
+    def result(self):
+        if self.data is not None:
+            # Verify that we wrote all the data
+            if self.pos != len(self.values):
+                raise RuntimeError(f'Failed to hide all the data ({max(0, self.pos * self.bits // 8 - 4)}/{len(self.data)})')
+        else:
+            if self.needed is None or len(self.values) < self.needed:
+                raise RuntimeError('The hidden data is truncated')
+            return unpack_bitstream(self.values, self.bits, 4 + (self.needed * self.bits - 32) // 8)[4:]
+
+class ColorTableSizes(Handler):
+    """
+    Just collect the sizes of all the Color Tables
+
+    The sizes come from the descriptors, so the tables themselves are not read.
+    """
+
+    wants_color_tables = False
+
+    def __init__(self):
+        super(ColorTableSizes, self).__init__()
+        self.sizes = []
+
+    def screen_descriptor(self, event):
+        if event.has_ct:
+            self.sizes.append(color_table_size(event.ct_size))
+
+    def image_descriptor(self, event):
+        if event.has_ct:
+            self.sizes.append(color_table_size(event.ct_size))
+
+    def result(self):
+        return self.sizes
+
+def capacity(in_path, bits=None, stats=None):
+    """
+    The number of bytes of data that can be hidden in the file (-1 if not even empty data fits)
+
+    With bits unset this is for the one bit per byte-aligned layout (see
+    LsbHandler), otherwise for the continuous layout with that many bits per
+    Color Table entry (see BitPlaneHandler).
+    """
+    return sizes_capacity(run(in_path, None, ColorTableSizes(), stats), bits)
+
+def sizes_capacity(sizes, bits=None):
+    """
+    The number of bytes of data that can be hidden in Color Tables of the given sizes (see capacity)
+    """
+    if bits is None:
+        # Less the length byte, which also caps the data size
+        return min(255, max(-1, sum(size // 8 for size in sizes) - 1))
+    # Less the 4 byte length
+    return max(-1, sum(sizes) * bits // 8 - 4)
+
+def hide(src, data, out=None, bits=None, stats=None):
+    """
+    Hide data in the GIF src, returning the new GIF as bytes (or writing it to out)
+
+    If bits is set, use that many low bits of each entry in one continuous
+    bitstream (see BitPlaneHandler).
+    """
+    if bits is None:
+        return run_to_bytes(src, out, LsbHandler(data), stats)
+
+    # Check up front that it will fit, rather than after rewriting the file
+    src = rereadable(src)
+    available = capacity(src, bits, stats)
+    if len(data) > available:
+        raise RuntimeError(f'Failed to hide all the data ({max(0, available)}/{len(data)})')
+    return run_to_bytes(src, out, BitPlaneHandler(data, bits), stats)
+
+def extract(src, bits=None, stats=None):
+    """
+    Extract the data hidden in the GIF src
+    """
+    if bits is None:
+        return run(src, None, LsbHandler(), stats)
+    return run(src, None, BitPlaneHandler(bits=bits), stats)
+
+def steg(in_path, out_path=None, data=None, bits=None, stats=None):
+    """
+    The steg function (use the LSB of the color table entries to hide the data)
+
+    If bits is set, use that many low bits of each entry in one continuous
+    bitstream instead (see BitPlaneHandler).
+    """
+    if out_path is None:
+        return extract(in_path, bits, stats)
+    return hide(in_path, data, out_path, bits, stats)
@@ -0,0 +1,430 @@
+"""
+The GIF LZW codec of the GIF steganography suite
+
+Everything here works incrementally: data is fed in a sub-block (or a run of
+indices) at a time, so nothing ever needs more than the current frame in
+memory, and the code tables are fixed size (at most 4096 codes, per the GIF
+specification).
+
+Decoding and encoding step through the data a code (or an index) at a time,
+which pure Python can't do at more than a few million pixels a second.
+translate_codes avoids both wherever it can, and with NumPy it patches whole
+runs of codes at once.
+"""
+
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    # NumPy is optional, the pure Python loop below is used without it
+    numpy = None
+
+# Codes are at most 12 bits, so there are never more than this many of them
+MAX_CODES = 4096
+
+# The most codes translate_codes reads in one go with NumPy (encoders tend to
+# clear the table about this often, and anything read past a Clear Code is wasted)
+SEGMENT_CODES = MAX_CODES
+
+class Decoder(object):
+    """
+    Decode a GIF LZW code stream into palette indices
+    """
+
+    def __init__(self, lzw_min_size):
+        super(Decoder, self).__init__()
+        self.lzw_min_size = lzw_min_size
+        self.clear_code = 1 << lzw_min_size
+        self.eoi_code = self.clear_code + 1
+        # Bytes not yet fully decoded, and the bit position within them
+        # (codes are packed least significant bit first)
+        self.pending = b''
+        self.pos = 0
+        self.done = False
+        self.reset()
+
+    def reset(self):
+        """
+        Go back to the initial code table (on a Clear Code)
+        """
+        # The string of indices for each code
+        self.table = [bytes([code]) for code in range(self.clear_code)] + [b'', b'']
+        self.code_size = self.lzw_min_size + 1
+        self.prev = None
+
+    def feed(self, data):
+        """
+        Decode the next chunk of the code stream, returning the indices it completes
+        """
+        out = bytearray()
+        if self.done:
+            return out
+        # Unconsumed bytes plus a little zero padding, so every code can be
+        # read with a fixed three byte window
+        buf = self.pending + data + b'\x00\x00'
+        end = 8 * (len(buf) - 2)
+        pos = self.pos
+        table = self.table
+        code_size = self.code_size
+        mask = (1 << code_size) - 1
+        prev = self.prev
+        clear_code = self.clear_code
+        eoi_code = self.eoi_code
+
+        # The size of the table, and the size at which the codes get wider
+        size = len(table)
+        grow_at = 1 << code_size if code_size < 12 else MAX_CODES + 1
+        append = table.append
+
+        while pos + code_size <= end:
+            index = pos >> 3
+            code = ((buf[index] | (buf[index + 1] << 8) | (buf[index + 2] << 16)) >> (pos & 7)) & mask
+            pos += code_size
+
+            if code < size and code != clear_code and code != eoi_code:
+                entry = table[code]
+                # (the first code after a Clear Code adds nothing to the table)
+                if prev is not None and size < MAX_CODES:
+                    append(prev + entry[:1])
+                    size += 1
+                    if size == grow_at:
+                        code_size += 1
+                        mask = (1 << code_size) - 1
+                        grow_at = 1 << code_size if code_size < 12 else MAX_CODES + 1
+            elif code == clear_code:
+                self.reset()
+                table = self.table
+                append = table.append
+                size = len(table)
+                code_size = self.code_size
+                mask = (1 << code_size) - 1
+                grow_at = 1 << code_size
+                prev = None
+                continue
+            elif code == eoi_code:
+                self.done = True
+                break
+            elif code == size and prev is not None:
+                # The code being defined by this very step
+                entry = prev + prev[:1]
+                if size < MAX_CODES:
+                    append(entry)
+                    size += 1
+                    if size == grow_at:
+                        code_size += 1
+                        mask = (1 << code_size) - 1
+                        grow_at = 1 << code_size if code_size < 12 else MAX_CODES + 1
+            else:
+                raise RuntimeError('Invalid LZW code found while decoding')
+            out += entry
+            prev = entry
+
+        self.pending = bytes(buf[pos >> 3:len(buf) - 2])
+        self.pos = pos & 7
+        self.code_size = code_size
+        self.prev = prev
+        return out
+
+class Encoder(object):
+    """
+    Encode palette indices into a GIF LZW code stream
+
+    The code table is a flat array indexed by (prefix code, next index), so
+    each step is an array lookup rather than building and hashing strings.
+    The table is 2 MB, so rather than building a new Encoder for every frame,
+    restart the same one.
+    """
+
+    def __init__(self, lzw_min_size):
+        super(Encoder, self).__init__()
+        self.children = array('H', bytes(2 * MAX_CODES * 256))
+        self.used = []
+        self.restart(lzw_min_size)
+
+    def restart(self, lzw_min_size):
+        """
+        Start a new code stream, reusing the code table
+        """
+        self.clear_table()
+        self.lzw_min_size = lzw_min_size
+        self.clear_code = 1 << lzw_min_size
+        self.eoi_code = self.clear_code + 1
+        self.bits = 0
+        self.num_bits = 0
+        self.out = bytearray()
+        self.prefix = None
+        self.code_size = self.lzw_min_size + 1
+        self.next_code = self.eoi_code + 1
+        # Start off with a Clear Code, as is customary
+        self.emit(self.clear_code)
+
+    def clear_table(self):
+        """
+        Empty the code table
+        """
+        children = self.children
+        for key in self.used:
+            children[key] = 0
+        del self.used[:]
+
+    def emit(self, code):
+        """
+        Pack a code onto the output
+        """
+        self.bits |= code << self.num_bits
+        self.num_bits += self.code_size
+        if self.num_bits >= 8:
+            num_bytes = self.num_bits // 8
+            self.out += (self.bits & ((1 << (8 * num_bytes)) - 1)).to_bytes(num_bytes, 'little')
+            self.bits >>= 8 * num_bytes
+            self.num_bits -= 8 * num_bytes
+
+    def feed(self, indices):
+        """
+        Encode the next run of indices, returning the code stream bytes it completes
+        """
+        indices = iter(indices)
+        prefix = self.prefix
+        if prefix is None:
+            prefix = next(indices, None)
+            if prefix is None:
+                return b''
+        children = self.children
+        used = self.used
+        out = self.out
+        # The emit loop, kept in locals (codes are packed a word at a time)
+        bits = self.bits
+        num_bits = self.num_bits
+        code_size = self.code_size
+        next_code = self.next_code
+        grow_at = 1 << code_size if code_size < 12 else MAX_CODES + 1
+        for index in indices:
+            key = (prefix << 8) | index
+            code = children[key]
+            if code:
+                prefix = code
+                continue
+
+            bits |= prefix << num_bits
+            num_bits += code_size
+            if num_bits >= 32:
+                out += (bits & 0xFFFFFFFF).to_bytes(4, 'little')
+                bits >>= 32
+                num_bits -= 32
+            # Switch to wider codes at the same point the decoder will
+            if next_code >= grow_at:
+                code_size += 1
+                grow_at = 1 << code_size if code_size < 12 else MAX_CODES + 1
+            if next_code >= MAX_CODES - 1:
+                # The table is full, so start over
+                bits |= self.clear_code << num_bits
+                num_bits += code_size
+                self.clear_table()
+                code_size = self.lzw_min_size + 1
+                grow_at = 1 << code_size
+                next_code = self.eoi_code + 1
+            else:
+                children[key] = next_code
+                used.append(key)
+                next_code += 1
+            prefix = index
+        self.prefix = prefix
+        self.bits = bits
+        self.num_bits = num_bits
+        self.code_size = code_size
+        self.next_code = next_code
+
+        # Hand over the whole bytes packed so far
+        num_bytes = self.num_bits // 8
+        if num_bytes:
+            out += (self.bits & ((1 << (8 * num_bytes)) - 1)).to_bytes(num_bytes, 'little')
+            self.bits >>= 8 * num_bytes
+            self.num_bits -= 8 * num_bytes
+        data = bytes(out)
+        del out[:]
+        return data
+
+    def finish(self):
+        """
+        Flush out the last codes and the End of Information Code
+        """
+        if self.prefix is not None:
+            self.emit(self.prefix)
+            if self.next_code >= (1 << self.code_size) and self.code_size < 12:
+                self.code_size += 1
+        self.emit(self.eoi_code)
+        if self.num_bits:
+            self.out += self.bits.to_bytes((self.num_bits + 7) // 8, 'little')
+            self.bits = 0
+            self.num_bits = 0
+        out = bytes(self.out)
+        del self.out[:]
+        self.prefix = None
+        return out
+
+def segment_length(table_size, code_size, eoi_code):
+    """
+    How many codes from here on are read at code_size bits before it may grow
+
+    table_size is the size of the decoder's code table, or None straight after
+    a Clear Code. None means there is no limit.
+    """
+    if code_size >= 12:
+        return None
+    if table_size is None:
+        # The first code after a Clear Code adds nothing to the table
+        count = (1 << code_size) - eoi_code
+    else:
+        count = (1 << code_size) - table_size
+    return count if count > 0 else None
+
+def patch_segment(buf, pos, count, code_size, table, clear_code, eoi_code):
+    """
+    Translate the literal codes among the next count codes at code_size bits, in place
+
+    Stops at a Clear Code or End of Information Code. Returns the number of
+    codes translated and the code it stopped at (or None), or None if some
+    literal translates to an index that isn't a literal.
+    """
+    mask = (1 << code_size) - 1
+    start = pos
+    limit = pos + count * code_size
+    special = None
+    while pos < limit:
+        index = pos >> 3
+        shift = pos & 7
+        window = buf[index] | (buf[index + 1] << 8) | (buf[index + 2] << 16)
+        code = (window >> shift) & mask
+        if code < clear_code:
+            # Patch the literal in place
+            new_code = table[code]
+            if new_code != code:
+                if new_code >= clear_code:
+                    return None
+                window ^= (code ^ new_code) << shift
+                buf[index] = window & 0xFF
+                buf[index + 1] = (window >> 8) & 0xFF
+                buf[index + 2] = window >> 16
+        elif code <= eoi_code:
+            special = code
+            break
+        pos += code_size
+    return (pos - start) // code_size, special
+
+def patch_segment_numpy(codes_buf, pos, count, code_size, table, clear_code, eoi_code, patches):
+    """
+    Like patch_segment, for a NumPy view of the buffer, with all the codes read at once
+
+    Rather than being made in place, the patches are appended to patches as
+    (byte positions, 24 bit XOR masks), to be applied together at the end.
+    """
+    bit_pos = pos + code_size * numpy.arange(count, dtype=numpy.int64)
+    index = bit_pos >> 3
+    shift = (bit_pos & 7).astype(numpy.uint32)
+    window = (codes_buf[index].astype(numpy.uint32) | (codes_buf[index + 1].astype(numpy.uint32) << 8) |
+              (codes_buf[index + 2].astype(numpy.uint32) << 16))
+    codes = (window >> shift) & ((1 << code_size) - 1)
+
+    # Only as far as the first Clear Code or End of Information Code
+    specials = numpy.flatnonzero((codes == clear_code) | (codes == eoi_code))
+    special = None
+    if len(specials):
+        count = int(specials[0])
+        special = int(codes[count])
+    literal = codes[:count] < clear_code
+    codes = codes[:count][literal]
+    new_codes = table[codes]
+    if len(new_codes) and int(new_codes.max()) >= clear_code:
+        return None
+    masks = (codes ^ new_codes) << shift[:count][literal]
+    changed = masks != 0
+    patches.append((index[:count][literal][changed], masks[changed]))
+    return count, special
+
+def apply_patches(codes_buf, patches):
+    """
+    XOR the patches collected by patch_segment_numpy into the buffer
+
+    The patches of different codes never share a bit, so adding them up per
+    byte is the same as XORing them in one at a time.
+    """
+    if not patches:
+        return
+    index = numpy.concatenate([index for index, _ in patches])
+    masks = numpy.concatenate([masks for _, masks in patches])
+    total = numpy.zeros(len(codes_buf), dtype=numpy.float64)
+    for byte in range(3):
+        total += numpy.bincount(index + byte, weights=(masks >> (8 * byte)) & 0xFF, minlength=len(codes_buf))
+    codes_buf ^= total.astype(numpy.uint8)
+
+def translate_codes(data, lzw_min_size, table):
+    """
+    Re-map the palette indices of a code stream without decoding it
+
+    Mapping every index through the same table maps every string in the code
+    table the same way, so only the literal codes (those below the Clear Code)
+    need changing, and every code keeps its width. Every index in the image
+    first turns up as a literal, so this works as long as each literal in the
+    stream translates to an index that is itself a literal, i.e. below
+    1 << lzw_min_size.
+
+    Returns the translated code stream, which is the same length as data, or
+    None if some literal can't be translated.
+    """
+    clear_code = 1 << lzw_min_size
+    eoi_code = clear_code + 1
+    if all(table[code] == code for code in range(min(clear_code, len(table)))):
+        # Nothing to change
+        return bytes(data)
+    code_size = lzw_min_size + 1
+    # The size of the code table, or None straight after a Clear Code
+    table_size = None
+    # A little zero padding, so every code can be read with a fixed three byte window
+    buf = bytearray(data)
+    buf += b'\x00\x00'
+    end = 8 * len(data)
+    pos = 0
+    if numpy is not None:
+        codes_buf = numpy.frombuffer(buf, dtype=numpy.uint8)
+        table = numpy.frombuffer(bytes(table), dtype=numpy.uint8).astype(numpy.uint32)
+        patches = []
+
+    while True:
+        # The codes that are all the same width
+        count = (end - pos) // code_size
+        limit = segment_length(table_size, code_size, eoi_code)
+        if limit is not None:
+            count = min(count, limit)
+        if count == 0:
+            break
+        if numpy is not None:
+            done = patch_segment_numpy(codes_buf, pos, min(count, SEGMENT_CODES), code_size, table, clear_code,
+                                       eoi_code, patches)
+        else:
+            done = patch_segment(buf, pos, count, code_size, table, clear_code, eoi_code)
+        if done is None:
+            return None
+        count, special = done
+        pos += count * code_size
+
+        # Follow along with the size of the decoder's code table
+        if count:
+            if table_size is None:
+                table_size = eoi_code + count
+            else:
+                table_size = min(MAX_CODES, table_size + count)
+            if table_size == (1 << code_size) and code_size < 12:
+                code_size += 1
+
+        if special == clear_code:
+            pos += code_size
+            code_size = lzw_min_size + 1
+            table_size = None
+        elif special == eoi_code:
+            # Anything after this is padding
+            break
+
+    if numpy is not None:
+        apply_patches(codes_buf, patches)
+    return bytes(buf[:len(data)])
@@ -0,0 +1,80 @@
+"""
+The Color Table helpers of the GIF steganography suite
+
+Colors are handled as packed 0xRRGGBB integers.
+"""
+
+from array import array
+import sys
+
+def decode(ct):
+    """
+    Convert a raw Color Table to a list of packed colors
+    """
+    # Spread the RGB triples out into big endian 32-bit words and read them all at once
+    words = bytearray(len(ct) // 3 * 4)
+    words[1::4] = ct[0::3]
+    words[2::4] = ct[1::3]
+    words[3::4] = ct[2::3]
+    colors = array('I', bytes(words))
+    if sys.byteorder == 'little':
+        colors.byteswap()
+    return colors.tolist()
+
+def encode(colors):
+    """
+    Convert a list of packed colors to a raw Color Table
+    """
+    words = array('I', colors)
+    if sys.byteorder == 'little':
+        words.byteswap()
+    words = words.tobytes()
+    ct = bytearray(len(colors) * 3)
+    ct[0::3] = words[1::4]
+    ct[1::3] = words[2::4]
+    ct[2::3] = words[3::4]
+    return ct
+
+def unique(colors):
+    """
+    The distinct colors, in order of first appearance
+    """
+    return list(dict.fromkeys(colors))
+
+def duplicates(colors):
+    """
+    The repeated colors (every copy after the first), in order of appearance
+    """
+    seen = set()
+    repeats = []
+    for color in colors:
+        if color in seen:
+            repeats.append(color)
+        seen.add(color)
+    return repeats
+
+def translation_table(old_colors, new_colors):
+    """
+    Build the translation from indices into old_colors to indices into new_colors
+
+    The n-th copy of a color in old_colors maps to the n-th copy of it in
+    new_colors (or the first, if there are fewer), so tables with repeated
+    colors keep their indices distinct (which matters for, say, a transparent
+    index that shares its color with an opaque one).
+
+    The result is a 256 byte table that can be used directly with
+    bytes.translate on image data. Indices past the end of the table are left
+    as they are.
+    """
+    # Where each color ended up
+    positions = {}
+    for pos, color in enumerate(new_colors):
+        positions.setdefault(color, []).append(pos)
+    table = bytearray(range(256))
+    copies = {}
+    for pos, color in enumerate(old_colors):
+        copy = copies.get(color, 0)
+        copies[color] = copy + 1
+        slots = positions[color]
+        table[pos] = slots[copy] if copy < len(slots) else slots[0]
+    return bytes(table)
@@ -0,0 +1,173 @@
+"""
+The permutation ranking helpers of the GIF steganography suite
+
+A permutation of n items is described by its order: order[i] is the slot
+that the i-th item ends up in. Its rank is the number whose factorial base
+(Lehmer code) digits say, for each item in turn, how many of the still free
+slots come before the one it takes. Both directions use a binary indexed
+(Fenwick) tree over the free slots, so they take O(n log n) steps rather than
+shifting lists around.
+
+Converting between a rank and its digits is done by divide and conquer over
+a cached tree of products of the radices, so it needs a handful of big
+multiplications and divisions rather than one per digit.
+"""
+
+from functools import lru_cache
+import math
+
+# Below this many digits, plain digit-by-digit conversion is quicker
+MIXED_RADIX_CUTOFF = 16
+
+@lru_cache(maxsize=None)
+def factorial(n):
+    """
+    n! (cached, since the same palette sizes come up over and over)
+    """
+    return math.factorial(n)
+
+@lru_cache(maxsize=None)
+def factoradic_radices(n):
+    """
+    The radices of the Lehmer code of a permutation of n items
+    """
+    return tuple(range(n, 0, -1))
+
+@lru_cache(maxsize=64)
+def radix_products(radices):
+    """
+    The products of the radices over each range the conversions split on
+
+    Maps (lo, hi) to the product of radices[lo:hi].
+    """
+    products = {}
+
+    def build(lo, hi):
+        if hi - lo <= MIXED_RADIX_CUTOFF:
+            product = math.prod(radices[lo:hi])
+        else:
+            mid = (lo + hi) // 2
+            product = build(lo, mid) * build(mid, hi)
+        products[(lo, hi)] = product
+        return product
+
+    build(0, len(radices))
+    return products
+
+def from_mixed_radix(digits, radices):
+    """
+    The number with the given digits (most significant first) in the given radices
+    """
+    radices = tuple(radices)
+    products = radix_products(radices)
+
+    def convert(lo, hi):
+        if hi - lo <= MIXED_RADIX_CUTOFF:
+            number = 0
+            for i in range(lo, hi):
+                number = number * radices[i] + digits[i]
+            return number
+        mid = (lo + hi) // 2
+        return convert(lo, mid) * products[(mid, hi)] + convert(mid, hi)
+
+    return convert(0, len(radices)) if radices else 0
+
+def to_mixed_radix(number, radices):
+    """
+    The digits (most significant first) of number in the given radices
+    """
+    radices = tuple(radices)
+    products = radix_products(radices)
+    digits = [0] * len(radices)
+
+    def convert(number, lo, hi):
+        if hi - lo <= MIXED_RADIX_CUTOFF:
+            for i in range(hi - 1, lo - 1, -1):
+                number, digits[i] = divmod(number, radices[i])
+            return
+        mid = (lo + hi) // 2
+        high, low = divmod(number, products[(mid, hi)])
+        convert(high, lo, mid)
+        convert(low, mid, hi)
+
+    if radices:
+        convert(number, 0, len(radices))
+    return digits
+
+def free_slots(n):
+    """
+    A binary indexed tree over n slots, all of them free
+    """
+    # Each node counts the free slots in the range it covers
+    return [0] + [index & -index for index in range(1, n + 1)]
+
+def take_slot(tree, slot):
+    """
+    Mark a (0-indexed) slot as no longer free
+    """
+    index = slot + 1
+    while index < len(tree):
+        tree[index] -= 1
+        index += index & -index
+
+def count_free_before(tree, slot):
+    """
+    Count the free slots before a (0-indexed) slot
+    """
+    count = 0
+    index = slot
+    while index > 0:
+        count += tree[index]
+        index -= index & -index
+    return count
+
+def find_free(tree, count):
+    """
+    Find the (0-indexed) slot that has count free slots before it
+    """
+    pos = 0
+    step = 1 << (len(tree) - 1).bit_length()
+    while step:
+        index = pos + step
+        if index < len(tree) and tree[index] <= count:
+            pos = index
+            count -= tree[index]
+        step >>= 1
+    return pos
+
+def lehmer_code(order):
+    """
+    Convert an order to its Lehmer code
+
+    Digit i is in base n - i, so the last digit is always 0.
+    """
+    tree = free_slots(len(order))
+    digits = []
+    for slot in order:
+        digits.append(count_free_before(tree, slot))
+        take_slot(tree, slot)
+    return digits
+
+def lehmer_decode(digits):
+    """
+    Convert a Lehmer code back to an order
+    """
+    tree = free_slots(len(digits))
+    order = []
+    for digit in digits:
+        slot = find_free(tree, digit)
+        order.append(slot)
+        take_slot(tree, slot)
+    return order
+
+def rank(order):
+    """
+    The number of a permutation (between 0 and n! - 1)
+    """
+    return from_mixed_radix(lehmer_code(order), factoradic_radices(len(order)))
+
+def unrank(number, n):
+    """
+    The permutation of n items with the given number
+    """
+    return lehmer_decode(to_mixed_radix(number, factoradic_radices(n)))
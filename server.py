@@ -0,0 +1,283 @@
+"""
+The HTTP service of the GIF steganography suite
+
+A small stdlib-only server, so a long running process can hide and extract
+without paying interpreter startup per request:
+
+    POST /hide?method=M[&payload=P]     the GIF is the body, the new GIF is returned
+    POST /extract?method=M              the GIF is the body, the hidden data is returned
+    GET  /metrics                       request counts and latency histograms
+
+The payload for /hide comes either from the (percent-encoded) payload query
+parameter, or, if an X-Payload-Length header is sent, from that many bytes at
+the start of the body, right before the GIF. The lsb bits and shuffle striped
+options, and the compress codec and level (see compression.py), can be given
+as query parameters too.
+
+Connections are kept alive and handled by a fixed pool of worker threads. The
+GIF is parsed straight from the request body as it arrives.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, unquote_to_bytes, urlsplit
+import http.server
+import io
+import threading
+import time
+
+from session import METHODS, Session
+import compression
+
+# The upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# How long an idle keep-alive connection may hold a worker
+IDLE_TIMEOUT = 30
+
+# The endpoints that get metrics of their own (any other is counted as other)
+ENDPOINTS = ('/hide', '/extract')
+
+class BodyReader(io.RawIOBase):
+    """
+    A file object over the next length bytes of a stream (a request body)
+    """
+
+    def __init__(self, stream, length):
+        super(BodyReader, self).__init__()
+        self.stream = stream
+        self.remaining = length
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        size = min(len(buf), self.remaining)
+        if size == 0:
+            return 0
+        data = self.stream.read(size)
+        buf[:len(data)] = data
+        self.remaining -= len(data)
+        return len(data)
+
+    def drain(self):
+        """
+        Skip whatever is left of the body, so the connection can be reused
+        """
+        while self.read(1 << 16):
+            pass
+
+class Metrics(object):
+    """
+    Request counts and latency histograms, by endpoint, method and status
+    """
+
+    def __init__(self):
+        super(Metrics, self).__init__()
+        self.lock = threading.Lock()
+        # (endpoint, method, status) -> [bucket counts..., count, total seconds]
+        self.series = {}
+
+    def observe(self, endpoint, method, status, seconds):
+        """
+        Record one request
+
+        Unknown endpoints and methods are all counted as other, so clients
+        can't add series without bound.
+        """
+        if endpoint not in ENDPOINTS:
+            endpoint = 'other'
+        if method is not None and method not in METHODS:
+            method = 'other'
+        key = (endpoint, method or '', status)
+        with self.lock:
+            counts = self.series.get(key)
+            if counts is None:
+                counts = self.series[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += seconds
+
+    def render(self):
+        """
+        The metrics in the Prometheus text format
+        """
+        lines = ['# TYPE gifsteg_request_seconds histogram']
+        with self.lock:
+            series = sorted((key, list(counts)) for key, counts in self.series.items())
+        for (endpoint, method, status), counts in series:
+            labels = f'endpoint="{endpoint}",method="{method}",status="{status}"'
+            for bound, count in zip(LATENCY_BUCKETS, counts):
+                lines.append(f'gifsteg_request_seconds_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'gifsteg_request_seconds_bucket{{{labels},le="+Inf"}} {counts[-2]}')
+            lines.append(f'gifsteg_request_seconds_count{{{labels}}} {counts[-2]}')
+            lines.append(f'gifsteg_request_seconds_sum{{{labels}}} {counts[-1]:.6f}')
+        return '\n'.join(lines) + '\n'
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Handles the requests of one connection
+    """
+
+    protocol_version = 'HTTP/1.1'
+    timeout = IDLE_TIMEOUT
+
+    def do_GET(self):
+        if urlsplit(self.path).path != '/metrics':
+            self.respond(404, b'Not found\n')
+            return
+        self.respond(200, self.server.metrics.render().encode('utf-8'), 'text/plain; version=0.0.4')
+
+    def do_POST(self):
+        start = time.perf_counter()
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        method = query.get('method', [None])[0]
+        status = self.handle_steg(url.path, method, url.query, query)
+        self.server.metrics.observe(url.path, method, status, time.perf_counter() - start)
+
+    def handle_steg(self, endpoint, method, raw_query, query):
+        """
+        Carry out a hide or extract request, returning the response status
+        """
+        try:
+            length = int(self.headers['Content-Length'])
+        except (TypeError, ValueError):
+            self.close_connection = True
+            return self.respond(411, b'A valid Content-Length is required\n')
+        if length < 0:
+            self.close_connection = True
+            return self.respond(400, b'The Content-Length cannot be negative\n')
+        body = BodyReader(self.rfile, length)
+        try:
+            if endpoint not in ENDPOINTS:
+                return self.respond(404, b'Not found\n')
+            try:
+                session = Session(method, **self.options(method, query))
+            except (RuntimeError, ValueError) as e:
+                return self.respond(400, f'{e}\n'.encode('utf-8'))
+
+            try:
+                if endpoint == '/hide':
+                    try:
+                        payload = self.payload(body, raw_query)
+                    except ValueError as e:
+                        return self.respond(400, f'{e}\n'.encode('utf-8'))
+                    if payload is None:
+                        return self.respond(400, b'No payload given\n')
+                    return self.respond(200, session.hide(body, payload), 'image/gif')
+                return self.respond(200, session.extract(body))
+            except RuntimeError as e:
+                return self.respond(422, f'{e}\n'.encode('utf-8'))
+            except Exception as e:
+                self.log_error('%s failed: %r', endpoint, e)
+                return self.respond(500, b'Internal error\n')
+        finally:
+            body.drain()
+
+    def options(self, method, query):
+        """
+        The method specific options given in the query
+        """
+        options = {}
+        if 'bits' in query:
+            if method != 'lsb':
+                raise ValueError('bits can only be used with lsb')
+            options['bits'] = int(query['bits'][0])
+            if not 1 <= options['bits'] <= 4:
+                raise ValueError('bits must be between 1 and 4')
+        if 'striped' in query:
+            if method != 'shuffle':
+                raise ValueError('striped can only be used with shuffle')
+            options['striped'] = query['striped'][0] not in ('', '0', 'false')
+        if 'compress' in query:
+            options['compress'] = query['compress'][0]
+            if options['compress'] not in ('auto',) + compression.available():
+                raise ValueError(f"unknown codec {options['compress']}")
+        if 'level' in query:
+            if 'compress' not in query:
+                raise ValueError('level can only be used with compress')
+            options['level'] = int(query['level'][0])
+            if not 0 <= options['level'] <= 9:
+                raise ValueError('level must be between 0 and 9')
+        return options
+
+    def payload(self, body, raw_query):
+        """
+        The data to hide, from the start of the body or the query
+
+        Raises a ValueError if X-Payload-Length isn't a length within the body.
+        """
+        length = self.headers.get('X-Payload-Length')
+        if length is not None:
+            try:
+                length = int(length)
+            except ValueError:
+                raise ValueError('X-Payload-Length must be a number') from None
+            if not 0 <= length <= body.remaining:
+                raise ValueError('X-Payload-Length must be between 0 and the Content-Length')
+            payload = body.read(length)
+            if len(payload) != length:
+                raise ValueError('The body ended before the payload did')
+            return payload
+        for field in raw_query.split('&'):
+            name, _, value = field.partition('=')
+            if name == 'payload':
+                return unquote_to_bytes(value.replace('+', ' '))
+        return None
+
+    def respond(self, status, body, content_type='application/octet-stream'):
+        """
+        Send a complete response, returning its status
+        """
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return status
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super(RequestHandler, self).log_message(format, *args)
+
+    def log_error(self, format, *args):
+        # Errors go to stderr whether or not every request is being logged
+        super(RequestHandler, self).log_message(format, *args)
+
+class Server(http.server.HTTPServer):
+    """
+    An HTTP server that hands each connection to a fixed pool of worker threads
+    """
+
+    def __init__(self, address, workers=None, verbose=False):
+        super(Server, self).__init__(address, RequestHandler)
+        self.pool = ThreadPoolExecutor(workers)
+        self.metrics = Metrics()
+        self.verbose = verbose
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super(Server, self).server_close()
+        self.pool.shutdown()
+
+def serve(host='127.0.0.1', port=8080, workers=None, verbose=False):
+    """
+    Run the server until interrupted
+    """
+    with Server((host, port), workers, verbose) as server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,89 @@
+"""
+The session objects of the GIF steganography suite
+
+A Session binds a steganography method to its options once, and can then hide
+and extract any number of times. Every call builds its own Handler, so nothing
+is carried over from one call to the next and a single Session can be shared
+by any number of threads at once.
+"""
+
+import importlib
+
+import compression
+
+# The steganography methods, by module name
+METHODS = ('append', 'comment', 'extension', 'lsb', 'shuffle')
+
+def load_method(method):
+    """
+    Import the module implementing a steganography method
+    """
+    if method not in METHODS:
+        raise RuntimeError(f'Unknown steganography method {method!r}')
+    return importlib.import_module(method)
+
+class Session(object):
+    """
+    A steganography method and its options (e.g. bits for lsb, striped for shuffle)
+
+    If stats is given, it is called with a report of each run (see stats.py).
+    If compress is given, the data is compressed with that codec ('auto' to
+    pick one, see compression.py) and level before it is hidden, and
+    decompressed again after it is extracted.
+    """
+
+    def __init__(self, method, stats=None, compress=None, level=None, **options):
+        super(Session, self).__init__()
+        # Only the name is kept, so that a Session can be pickled (e.g. to go
+        # to a process pool), but an unknown one is still caught here
+        load_method(method)
+        self.method = method
+        self.compress = compress
+        self.level = level
+        self.options = options
+        if stats is not None:
+            self.options['stats'] = stats
+
+    @property
+    def module(self):
+        """
+        The module implementing the method
+        """
+        return load_method(self.method)
+
+    def capacity(self, src):
+        """
+        The number of bytes of data that can be hidden in the GIF src (None if there is no limit)
+
+        It is -1 if not even empty data fits. With compression, this is the room
+        for the compressed data.
+        """
+        available = self.module.capacity(src, **self.options)
+        if self.compress is not None and available is not None:
+            available = max(-1, available - compression.HEADER_SIZE)
+        return available
+
+    def hide(self, src, data, out=None):
+        """
+        Hide data in the GIF src, returning the new GIF as bytes (or writing it to out)
+        """
+        if self.compress is not None:
+            data = compression.pack(data, self.compress, self.level)
+        return self.module.hide(src, data, out, **self.options)
+
+    def extract(self, src):
+        """
+        Extract the data hidden in the GIF src
+        """
+        data = self.module.extract(src, **self.options)
+        if self.compress is not None:
+            data = compression.unpack(data)
+        return data
+
+    def steg(self, in_path, out_path=None, data=None):
+        """
+        The steg function of the method, with the session's options
+        """
+        if out_path is None:
+            return self.extract(in_path)
+        return self.hide(in_path, data, out_path)
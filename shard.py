@@ -0,0 +1,183 @@
+"""
+The sharding of the GIF steganography suite
+
+Spreads a payload too big for any one carrier across several of them. The
+payload is cut into chunks, each sized to fill the carrier it goes in, and
+every chunk is hidden behind a small header:
+
+    stream id   4 bytes, random, shared by every chunk of the payload
+    index       2 bytes, the position of the chunk in the payload
+    count       2 bytes, how many chunks there are
+    checksum    4 bytes, the CRC-32 of the chunk
+
+The chunks are hidden in parallel as a batch (see batch.py). They can be
+reassembled from the carriers in any order: a first pass extracts each chunk
+but keeps only its header, building an index of which carrier holds which
+chunk, and a second pass reads the chunks in order and writes each one out as
+soon as it arrives, so only a handful of chunks are ever held at once.
+"""
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import os
+import struct
+import zlib
+
+from batch import CHUNKS_PER_JOB, Task, check_outputs, expand_inputs
+import compression
+from session import Session
+
+# The header in front of every chunk
+HEADER = struct.Struct('>4sHHI')
+
+# The most chunks a payload can be cut into
+MAX_CHUNKS = 0xFFFF
+
+def chunk_header(stream_id, index, count, chunk):
+    """
+    The header for a chunk of a payload
+    """
+    return HEADER.pack(stream_id, index, count, zlib.crc32(chunk))
+
+def hide_tasks(method, data, paths, out_dir, options):
+    """
+    The tasks to hide data in chunks across the input files
+
+    The carriers are used in the order given, each taking as much of the rest
+    of the data as it can hold, and only as many as are needed. If compress is
+    among the options, the data is compressed as a whole before it is cut up.
+    """
+    options = dict(options)
+    compress, level = options.pop('compress', None), options.pop('level', None)
+    if compress is not None:
+        data = compression.pack(data, compress, level)
+    session = Session(method, **options)
+
+    # Work out how much goes in each carrier
+    plan = []
+    taken = 0
+    for in_file, rel_path in expand_inputs(paths):
+        if plan and taken == len(data):
+            break
+        available = session.capacity(in_file)
+        if available is not None and available - HEADER.size < (1 if data else 0):
+            # Not even room for the header and a byte of the data
+            continue
+        end = len(data) if available is None else min(len(data), taken + available - HEADER.size)
+        plan.append((in_file, os.path.join(out_dir, rel_path), taken, end))
+        taken = end
+    if taken < len(data) or not plan:
+        raise RuntimeError(f'The input files can only hold {taken}/{len(data)} bytes of the data')
+    if len(plan) > MAX_CHUNKS:
+        raise RuntimeError(f'The data would need {len(plan)} chunks, but at most {MAX_CHUNKS} are allowed')
+
+    stream_id = os.urandom(4)
+    tasks = []
+    for index, (in_file, out_file, start, end) in enumerate(plan):
+        chunk = data[start:end]
+        tasks.append(Task(method, in_file, out_file, chunk_header(stream_id, index, len(plan), chunk) + chunk,
+                          options))
+
+    # One chunk overwriting another would lose it, so write none of them
+    for task in check_outputs(tasks):
+        if task.error is not None:
+            raise RuntimeError(task.error)
+    return tasks
+
+def read_chunk(method, path, options):
+    """
+    The header fields and the data of the chunk hidden in a file, with its checksum checked
+    """
+    try:
+        hidden = bytes(Session(method, **options).extract(path) or b'')
+    except RuntimeError as e:
+        raise RuntimeError(f'{path}: {e}') from e
+    if len(hidden) < HEADER.size:
+        raise RuntimeError(f'{path}: No chunk is hidden in this file')
+    stream_id, index, count, checksum = HEADER.unpack_from(hidden)
+    chunk = hidden[HEADER.size:]
+    if zlib.crc32(chunk) != checksum or index >= count:
+        raise RuntimeError(f'{path}: The chunk is damaged (or not a chunk at all)')
+    return stream_id, index, count, chunk
+
+def read_header(method, path, options):
+    """
+    The header fields of the chunk hidden in a file (see read_chunk)
+
+    The whole chunk has to be extracted (and checked) to get at them, but only
+    the header fields are kept, so an index of every file stays small.
+    """
+    return read_chunk(method, path, options)[:3]
+
+def build_index(headers):
+    """
+    Check that the chunk headers make up one whole payload, returning the carrier of each chunk in order
+    """
+    streams = {stream_id for _, (stream_id, _, _) in headers}
+    if len(streams) != 1:
+        raise RuntimeError(f'The files hold chunks of {len(streams)} different payloads '
+                           f"({', '.join(sorted(stream_id.hex() for stream_id in streams))})")
+    counts = {count for _, (_, _, count) in headers}
+    if len(counts) != 1:
+        raise RuntimeError('The chunks disagree on how many of them there are')
+    count = counts.pop()
+    index = [None] * count
+    for path, (_, chunk_index, _) in headers:
+        if index[chunk_index] is None:
+            index[chunk_index] = path
+    missing = [i for i, path in enumerate(index) if path is None]
+    if missing:
+        raise RuntimeError(f"Missing {len(missing)} of {count} chunks (numbers {', '.join(map(str, missing[:10]))}"
+                           f"{', ...' if len(missing) > 10 else ''})")
+    return streams.pop(), index
+
+def reassemble(method, paths, out_f, options, jobs=None):
+    """
+    Put back together the data hidden in chunks across the input files, in any order
+
+    The data is written to the binary file object out_f as it comes in, with
+    at most one chunk per worker process (of jobs) held at once. If compress
+    is among the options, the data is decompressed as it goes too. Returns a
+    summary of the payload.
+    """
+    options = dict(options)
+    compress = options.pop('compress', None)
+    options.pop('level', None)
+    files = [path for path, _ in expand_inputs(paths)]
+    if not files:
+        raise RuntimeError('No input files were given')
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    jobs = max(1, min(jobs, len(files)))
+    executor = ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else None
+    try:
+        # First where each chunk is
+        if executor is None:
+            headers = [read_header(method, path, options) for path in files]
+        else:
+            headers = list(executor.map(read_header, [method] * len(files), files, [options] * len(files),
+                                        chunksize=max(1, len(files) // (jobs * CHUNKS_PER_JOB))))
+        stream_id, index = build_index(list(zip(files, headers)))
+
+        # Then the chunks themselves, in order, with one in flight per worker
+        unpacker = compression.Unpacker() if compress is not None else None
+        size = 0
+        pending = deque()
+        for number, path in enumerate(index):
+            if executor is None:
+                pending.append(read_chunk(method, path, options))
+            else:
+                pending.append(executor.submit(read_chunk, method, path, options))
+            while pending and (len(pending) >= jobs or number == len(index) - 1):
+                result = pending.popleft()
+                chunk_id, _, _, chunk = result if executor is None else result.result()
+                if chunk_id != stream_id:
+                    raise RuntimeError('A file changed while the data was being put back together')
+                size += len(chunk)
+                out_f.write(chunk if unpacker is None else unpacker.feed(chunk))
+        if unpacker is not None:
+            out_f.write(unpacker.finish())
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return {'stream_id': stream_id.hex(), 'chunks': len(index), 'bytes': size}
@@ -2,304 +2,349 @@
 The shuffle implementation of the GIF steganography suite
 """
 
-from collections import OrderedDict
-from math import factorial
-from maybe_open import maybe_open
-import struct
-
-all_data = list()
+from gif_parser import Handler, iter_sub_blocks, make_sub_blocks, rereadable, run, run_to_bytes, sub_block_data
+from permutation import factorial, from_mixed_radix, rank, to_mixed_radix, unrank
+import lzw
+import math
+import palette
+import warnings
+
+def data_to_num(data):
+    """
+    Convert data to a permutation number
+    """
+    # Must start the message with a 1 to ensure the math works out nicely
+    # (otherwise leading zero bytes would be lost)
+    return int.from_bytes(b'\x01' + bytes(data), 'big')
 
 def num_to_data_len(num):
     """
     Convert a permutation number to the length of data it represents
     """
+    # Everything but the leading 1, in whole bytes
+    return max(0, (num.bit_length() - 1) // 8)
+
+def radix_capacity(radix):
+    """
+    The number of bytes of data whose permutation numbers are all below radix
+
+    This is -1 for a radix of 1, which has no room for even empty data.
+    """
+    # With the leading 1, k bytes of data can number up to 2 ** (8 * k + 1) - 1
+    return max(-1, (radix.bit_length() - 2) // 8)
+
+def num_to_data(num):
+    """
+    Convert a permutation number back to data
+    """
+    length = num_to_data_len(num)
     # Strip off the leading 1 that was added to make the math work
-    data = int(bin(num)[3:], 2)
-    # Convert from the integer form back to a string
-    data = hex(data)[2:]
-    # Return the length of the data
-    return len(data) // 2
-
-def copy_blocks(in_f, out_f):
-    """
-    Copy through blocks of data
-    """
-    while True:
-        # Read the block size
-        block_size = in_f.read(1)
-        if len(block_size) != 1:
-            raise RuntimeError('The Block is too short to be valid')
-        block_size, = struct.unpack('<B', block_size)
-
-        # Read the data in the block
-        block_data = in_f.read(block_size)
-        if len(block_data) != block_size:
-            raise RuntimeError('The Block is shorter than specified')
-
-        # Write the size and data to the output
-        out_f.write(bytes([block_size]))
-        out_f.write(block_data)
-
-        # Length zero block signals the end of the data
-        if block_size == 0:
-            break
-
-def remap_colors(in_f, out_f, lzw_min_size, image_size):
-    """
-    Un-compress the image data and re-map the color pointers
-    """
-    global translation
-    image = [0] * image_size;
-    pos = 0
-    # TODO initiliaze lzw params as needed
-    code_table = list(range((2 ** lzw_min_size) + 2))
-    while True:
-        # Read the block size
-        block_size = in_f.read(1)
-        if len(block_size) != 1:
-            raise RuntimeError('The Block is too short to be valid')
-        block_size, = struct.unpack('<B', block_size)
-
-        # Read the data in the block
-        block_data = in_f.read(block_size)
-        if len(block_data) != block_size:
-            raise RuntimeError('The Block is shorter than specified')
-
-        # Write the size and data to the output
-        out_f.write(bytes([block_size]))
-        out_f.write(block_data)
-
-        # Length zero block signals the end of the data
-        if block_size == 0:
-            break
-
-def extract_data(in_f, has_ct, ct_size):
-    """
-    Extract the data from the color table and add it to all_data
-    """
-    global all_data
-    if has_ct:
-        true_ct_size = 3 * (2 ** (ct_size + 1))
-        ct = bytearray(in_f.read(true_ct_size))
-        if len(ct) != true_ct_size:
-            raise RuntimeError('The Color Table is shorter than specified')
-
-        # Get the unique colors (RGB triples)
-        colors = [int(ct[i:i + 3].hex(), 16) for i in range(0, len(ct), 3)]
-        colors = list(OrderedDict.fromkeys(colors).keys())
-
-        # Pair the colors with their initial positions and sort
-        colors_and_positions = sorted(zip(colors, range(len(colors))))
-
-        # Extract the positions since that's all we actually need here
-        positions = [pos for color, pos in colors_and_positions]
-
-        # Reconstruct the data from the order
-        block_data = 0
-        for i in range(len(colors) - 1):
-            pos = positions[i]
-            block_data *= (len(colors) - i)
-            block_data += pos
-            # Shift subsequent colors down
-            for j in range(i + 1, len(colors)):
-                if positions[j] > pos:
-                    positions[j] -= 1
-
-        # Add the extracted data to all_data
-        all_data.append(block_data)
-
-translation = list()
-
-def hide_data(in_f, out_f, has_ct, ct_size, data, bg_color_index=None, aspect_ratio=None):
-    """
-    Insert the data into the color table and write to the output file
-    """
-    if has_ct:
-        true_ct_size = 3 * (2 ** (ct_size + 1))
-        ct = bytearray(in_f.read(true_ct_size))
-        if len(ct) != true_ct_size:
-            raise RuntimeError('The Color Table is shorter than specified')
-
-        # Get the unique colors (RGB triples) and sort them with the natural ordering
-        all_colors = [int(ct[i:i + 3].hex(), 16) for i in range(0, len(ct), 3)]
-        colors = list(OrderedDict.fromkeys(all_colors).keys())
-        colors.sort()
-
-        # Validate the data will fit
-        if data > factorial(len(colors)) - 1:
-            raise RuntimeError(f'Failed to hide all the data ({num_to_data_len(factorial(len(colors)) - 1)}/{num_to_data_len(data)})')
-
-        # Allocate the colors' positions based on remainders mod (data)
-        positions = [0 for _ in range(len(colors))]
-        for i in range(len(colors)):
-            positions[len(colors) - i - 1] = data % (i + 1)
-            data //= (i + 1)
-
-        # Re-order the colors based on these positions
-        new_colors = [0 for _ in range(len(colors))]
-        for i in range(len(colors)):
-            color = colors[len(colors) - i - 1]
-            pos = positions[len(colors) - i - 1]
-            # Shift colors up as needed to make room
-            new_colors[pos + 1:] = new_colors[pos:-1]
-            # Actually place the color
-            new_colors[pos] = color
-
-        # Actually make the new color table
-        new_ct = bytearray(len(ct))
-        for pos, color in enumerate(new_colors):
-            new_ct[pos * 3:pos * 3 + 3] = (((color >> 16) & 0xFF), ((color >> 8) & 0xFF), (color & 0xFF))
-        
-        # Pad the color table as needed with copies of the last color
-        for pos in range(len(colors), len(ct) // 3):
-            new_ct[pos * 3:pos * 3 + 3] = new_ct[pos * 3 - 3:pos * 3]
-
-        # Store the translation from original to modified color table so we can fix the image data later
-        global translation
-        translation = []
-        for color in all_colors:
-            for pos, new_color in enumerate(new_colors):
-                if color == new_color:
-                    translation.append(pos)
-                    break
-
-        # Write the modified bg_color_index and aspect ratio
-        if bg_color_index is not None:
-            out_f.write(bytes([translation[bg_color_index], aspect_ratio]))
-
-        # Write out the modified Color Table
-        out_f.write(new_ct)
-
-        # Return the number of bytes written into the Color Table
-        return True
+    return (num & ((1 << (8 * length)) - 1)).to_bytes(length, 'big')
+
+def remap_colors(data, lzw_min_size, translation, encoder=None):
+    """
+    Re-map the color pointers of the image data (LZW Minimum Code Size and sub-blocks)
+
+    encoder, if given, is an lzw.Encoder to restart rather than building a new
+    one. Returns the new image data
+    """
+    # As long as every index the image uses can still be written as a literal
+    # code, the code stream can be patched in place without decompressing it
+    codes = lzw.translate_codes(sub_block_data(data, 1), lzw_min_size, translation)
+    if codes is not None:
+        return bytes([lzw_min_size]) + make_sub_blocks(codes)
+
+    # Otherwise un-compress the image a sub-block at a time and re-compress it
+    # with a code size big enough for the new indices
+    clear_code = 1 << lzw_min_size
+    new_min_size = max(2, max(translation[:clear_code]).bit_length())
+    decoder = lzw.Decoder(lzw_min_size)
+    if encoder is None:
+        encoder = lzw.Encoder(new_min_size)
     else:
-        # Still have to save off the bg_colo_index and aspect_ratio
-        if bg_color_index is not None:
-            out_f.write(bytes([bg_color_index, aspect_ratio]))
-        # No Color Table => No space to hide stuff
-        return False
+        encoder.restart(new_min_size)
+    codes = bytearray()
+    for block in iter_sub_blocks(data, 1):
+        codes += encoder.feed(decoder.feed(block).translate(translation))
+    codes += encoder.finish()
+    return bytes([new_min_size]) + make_sub_blocks(codes)
+
+def extract_data(ct):
+    """
+    Extract the data from the color table
+    """
+    # Get the unique colors (RGB triples)
+    colors = palette.unique(palette.decode(ct))
 
-def steg(in_path, out_path=None, data=None):
+    # Pair the colors with their initial positions and sort
+    colors_and_positions = sorted(zip(colors, range(len(colors))))
+
+    # Extract the positions since that's all we actually need here
+    positions = [pos for color, pos in colors_and_positions]
+
+    # Reconstruct the data from the order
+    return rank(positions)
+
+def hide_data(ct, data):
     """
-    The steg function (use the ordering of the color table entries to hide the data)
+    Insert the data into the color table
+
+    Returns the modified Color Table and the translation from original to
+    modified color indices (as a table for bytes.translate)
+    """
+    # Get the unique colors (RGB triples) and sort them with the natural ordering
+    all_colors = palette.decode(ct)
+    colors = palette.unique(all_colors)
+    colors.sort()
+
+    # Validate the data will fit
+    if data >= factorial(len(colors)):
+        raise RuntimeError(f'Failed to hide all the data ({max(0, radix_capacity(factorial(len(colors))))}/{num_to_data_len(data)})')
+
+    # Re-order the colors based on the permutation numbered by the data
+    new_colors = [0 for _ in range(len(colors))]
+    for color, pos in zip(colors, unrank(data, len(colors))):
+        new_colors[pos] = color
+
+    # Actually make the new color table, padded out with the repeated colors so
+    # that every original index still has a slot of its own
+    new_colors += palette.duplicates(all_colors)
+    new_ct = palette.encode(new_colors)
+
+    # Store the translation from original to modified color table so we can fix the image data later
+    translation = palette.translation_table(all_colors, new_colors)
+
+    return new_ct, translation
+
+class ShuffleHandler(Handler):
+    """
+    Put the data into a permutation of the Color Table entries
+    """
+
+    def __init__(self, data=None):
+        super(ShuffleHandler, self).__init__()
+        if data is not None:
+            # Convert the message to a (propbably very large) integer
+            data = data_to_num(data)
+        self.data = data
+        self.hidden = False
+        self.screen_descriptor_event = None
+        # The translations for the Global Color Table and the current Local Color Table
+        self.global_translation = None
+        self.translation = None
+        # Output held back until the current frame's translation is known
+        # (everything from a Graphic Control Extension up to its image)
+        self.graphic_control = None
+        self.held = []
+        self.all_data = list()
+        # Shared by every frame that has to be re-encoded
+        self.encoder = None
+
+    def release(self, translation):
+        """
+        Let go of the held back output, fixing up the Graphic Control Extension for translation
+        """
+        gce, held = self.graphic_control, self.held
+        self.graphic_control = None
+        self.held = []
+        if gce is None:
+            return b''.join(held)
+        # Re-map the Transparent Color Index (if the Transparent Color Flag is set)
+        if translation is not None and len(gce) >= 8 and gce[2] >= 4 and (gce[3] & 0b00000001):
+            gce[6] = translation[gce[6]]
+        return bytes(gce) + b''.join(held)
+
+    def screen_descriptor(self, event):
+        if self.data is not None and event.has_ct:
+            # Annoyingly, we can't write the bg_color_index until _after_ the color map changes
+            self.screen_descriptor_event = event
+            return event.data[:5]
+
+    def image_descriptor(self, event):
+        if self.data is None:
+            return None
+        # A new frame, which uses the Global Color Table unless it has its own
+        self.translation = self.global_translation
+        if self.graphic_control is not None:
+            self.held.append(bytes(event.data))
+            return b''
+
+    def table_data(self, ct):
+        """
+        The number to hide in the next Color Table
+        """
+        # Hide a copy in each color map
+        return self.data
+
+    def color_table(self, event):
+        if self.data is None:
+            self.all_data.append(extract_data(event.data))
+            return None
+
+        new_ct, self.translation = hide_data(event.data, self.table_data(event.data))
+        self.hidden = True
+        if event.is_global:
+            self.global_translation = self.translation
+            # Write the modified bg_color_index and aspect ratio
+            screen = self.screen_descriptor_event
+            return bytes([self.translation[screen.bg_color_index], screen.aspect_ratio]) + new_ct
+        return self.release(self.translation) + new_ct
+
+    def image_data(self, event):
+        if self.data is None:
+            return None
+        held = self.release(self.translation)
+        if self.translation is None:
+            # No Color Table at all, so nothing to re-map
+            return held or None
+        if self.encoder is None:
+            self.encoder = lzw.Encoder(2)
+        return held + remap_colors(event.data, event.lzw_min_size, self.translation, self.encoder)
+
+    def extension(self, event):
+        if self.data is None:
+            return None
+        if event.label == 0xF9:
+            # Graphic Control, whose Transparent Color Index refers to whichever
+            # Color Table the next image uses, which isn't known yet
+            held = self.release(None)
+            self.graphic_control = bytearray(event.data)
+            return held
+        if event.label == 0x01:
+            # Plain Text, whose Foreground and Background Color Indices refer
+            # to the Global Color Table
+            plain_text = bytearray(event.data)
+            if self.global_translation is not None and len(plain_text) >= 15 and plain_text[2] >= 12:
+                plain_text[13] = self.global_translation[plain_text[13]]
+                plain_text[14] = self.global_translation[plain_text[14]]
+            return self.release(self.global_translation) + bytes(plain_text)
+        if self.graphic_control is not None:
+            self.held.append(bytes(event.data))
+            return b''
+        # Everything else is passed through all the same
+
+    def trailer(self, event):
+        if self.data is not None and self.graphic_control is not None:
+            # A Graphic Control Extension with no image to go with it
+            return self.release(None) + bytes(event.data)
+
+    def result(self):
+        if self.data is not None:
+            # If there was data to hide, make sure we hid it!
+            if not self.hidden:
+                raise RuntimeError('Failed to hide the data')
+        else:
+            # If data was None (the extracting case), return all the extracted data
+            all_data = [num_to_data(datum) for datum in self.all_data]
+            # Return the data
+            if len(set(all_data)) != 1:
+                # To stderr, since the data itself may be going to stdout
+                warnings.warn(f'multiple different messages recovered from different color maps: {all_data}')
+            return all_data[0]
+
+def table_radix(ct):
+    """
+    The number of permutations of the distinct colors of a Color Table
     """
+    return factorial(len(palette.unique(palette.decode(ct))))
 
-    hidden = False
-
-    if data is not None:
-        data_array = bytearray(data)
-        # Must start the message with a 1 to ensure the math works out nicely
-        data_array.insert(0, 1)
-        # Convert the message to a (propbably very large) integer
-        data = int(data_array.hex(), 16)
-
-    with open(in_path, 'rb') as in_f:
-        with maybe_open(out_path, 'wb') as out_f:
-            # First the Header
-            header = in_f.read(6)
-            if len(header) != 6:
-                raise RuntimeError('The Header is too short to be valid')
-            signature, version = struct.unpack('<3s3s', header)
-            if signature != b'GIF':
-                raise RuntimeError('The signature does not match the GIF specification')
-            out_f.write(header)
-
-            # Next the Logical Screen Descriptor
-            screen_descriptor = in_f.read(7)
-            if len(screen_descriptor) != 7:
-                raise RuntimeError('The Logical Screen Descriptor is too short to be valid')
-            width, height, packed, bg_color_index, aspect_ratio = struct.unpack('<2H3B', screen_descriptor)
-            has_gct   = (packed & 0b10000000) >> 7
-            color_res = (packed & 0b01110000) >> 4
-            sort_flag = (packed & 0b00001000) >> 3
-            gct_size  = (packed & 0b00000111) >> 0
-
-            # Then the Global Color Table (if present)
-            if data is not None:
-                # Annoyingly, we can't write the bg_color_index until _after_ the color map changes
-                out_f.write(struct.pack('<2HB', width, height, packed))
-                hidden = hide_data(in_f, out_f, has_gct, gct_size, data, bg_color_index, aspect_ratio)
-            else:
-                extract_data(in_f, has_gct, gct_size)
-
-            # Loop over the rest of the blocks in the image
-            while True:
-                # Read a byte to determine the block type
-                field = in_f.read(1)
-                if len(field) != 1:
-                    raise RuntimeError('Expected more data when there was none')
-                byte = field[0]
-
-                if byte == 0x2C:
-                    # Image Descriptor
-                    descriptor = in_f.read(9)
-                    if len(descriptor) != 9:
-                        raise RuntimeError('The Image Descriptor is too short to be valid')
-                    left_pos, top_pos, width, height, packed = struct.unpack('<4HB', descriptor)
-                    has_lct   = (packed & 0b10000000) >> 7
-                    interlace = (packed & 0b01000000) >> 6
-                    sort_flag = (packed & 0b00100000) >> 5
-                    reserved  = (packed & 0b00011000) >> 4
-                    lct_size  = (packed & 0b00000111) >> 0
-                    out_f.write(bytes([byte]))
-                    out_f.write(descriptor)
-
-                    # Then the Local Color Table (if present)
-                    if data is not None:
-                        # Hide a copy in each color map, this makes the re-coloring logic simpler
-                        hidden |= hide_data(in_f, out_f, has_lct, lct_size, data)
-                    else:
-                        extract_data(in_f, has_lct, lct_size)
-
-                    # Then the Table Based Image Data
-                    lzw_min_size = in_f.read(1)
-                    if len(lzw_min_size) != 1:
-                        raise RuntimeError('No LZW Minimum Code Size value')
-                    lzw_min_size, = struct.unpack('<B', lzw_min_size)
-                    out_f.write(bytes([lzw_min_size]))
-                    remap_colors(in_f, out_f, lzw_min_size, width * height)
-                elif byte == 0x21:
-                    # Extension Block
-                    block_label = in_f.read(1)
-                    if len(block_label) != 1:
-                        raise RuntimeError('No Extension Block label')
-                    out_f.write(bytes([byte]))
-                    out_f.write(block_label)
-
-                    # Just as a reference (for our purposes, we can pass these through all the same)
-                    #   F9 = Graphic Control
-                    #           TODO Should re-map the Transparent Color Index in this case
-                    #   FE = Comment
-                    #   01 = Plain Text
-                    #           TODO Should re-map the Text Foreground and Background Color Indices in this case
-                    #   FF = Application
-                    #   99 = Our Custom Extension Block Type
-
-                    # Copy the blocks
-                    copy_blocks(in_f, out_f)
-                elif byte == 0x3B:
-                    # Trailer
-                    out_f.write(bytes([byte]))
-                    break
-                else:
-                    raise RuntimeError(f'Unexpected byte {hex(byte)} found while decoding')
-
-            # Politely pass any extra appended data through :)
-            out_f.write(in_f.read())
-
-            if data is not None:
-                # If there was data to hide, make sure we hid it!
-                if not hidden:
-                    raise RuntimeError('Failed to hide the data')
-            else:
-                # If data was None (the extracting case), return all the extracted data
-                # Strip off the leading 1 that was added to make the math work
-                global all_data
-                all_data = [int(bin(datum)[3:], 2) for datum in all_data]
-                # Convert from the integer form back to a string
-                all_data = [bytes.fromhex(hex(datum)[2:]) for datum in all_data]
-                # Return the data
-                if len(set(all_data)) != 1:
-                    print('Warning: multiple different messages recovered from different color maps:')
-                    print(all_data)
-                return all_data[0]
+class StripedShuffleHandler(ShuffleHandler):
+    """
+    Put the data into the permutations of all the Color Tables together
+
+    Rather than a copy in each Color Table, the data is split across them as a
+    mixed radix number, with one digit per Color Table (in file order, most
+    significant first) whose radix is the number of permutations of that
+    table. The capacity is then the product of all the tables' capacities.
+    """
+
+    def __init__(self, data=None, radices=None):
+        super(StripedShuffleHandler, self).__init__(data)
+        if data is not None:
+            self.digits = to_mixed_radix(self.data, radices)
+        self.radices = []
+
+    def table_data(self, ct):
+        return self.digits[len(self.radices)]
+
+    def color_table(self, event):
+        new_ct = super(StripedShuffleHandler, self).color_table(event)
+        self.radices.append(table_radix(event.data) if self.data is None else None)
+        return new_ct
+
+    def result(self):
+        if self.data is not None:
+            return super(StripedShuffleHandler, self).result()
+        # Put the digits back together
+        return num_to_data(from_mixed_radix(self.all_data, self.radices))
+
+class TableRadices(Handler):
+    """
+    Just collect the radix of each Color Table (see table_radix)
+    """
+
+    def __init__(self):
+        super(TableRadices, self).__init__()
+        self.radices = []
+
+    def color_table(self, event):
+        self.radices.append(table_radix(event.data))
+
+    def result(self):
+        return self.radices
+
+def radices_capacity(radices, striped=False):
+    """
+    The number of bytes of data that can be hidden in Color Tables with the given radices (see capacity)
+    """
+    if striped:
+        return radix_capacity(math.prod(radices))
+    # Every Color Table carries its own copy (and there has to be one)
+    return radix_capacity(min(radices, default=1))
+
+def capacity(src, striped=False, stats=None):
+    """
+    The number of bytes of data that can be hidden in the file (-1 if not even empty data fits)
+
+    This depends on the number of distinct colors in each Color Table, so
+    unlike the other methods the tables themselves have to be read.
+    """
+    return radices_capacity(run(src, None, TableRadices(), stats), striped)
+
+def hide(src, data, out=None, striped=False, stats=None):
+    """
+    Hide data in the GIF src, returning the new GIF as bytes (or writing it to out)
+
+    If striped is set, split the data across all the color tables instead of
+    hiding a copy in each (see StripedShuffleHandler).
+    """
+    if not striped:
+        return run_to_bytes(src, out, ShuffleHandler(data), stats)
+
+    # The split depends on every Color Table, so they all have to be looked at first
+    src = rereadable(src)
+    radices = run(src, None, TableRadices(), stats)
+    number = data_to_num(data)
+    total = math.prod(radices)
+    if number >= total:
+        raise RuntimeError(f'Failed to hide all the data ({max(0, radix_capacity(total))}/{len(data)})')
+    return run_to_bytes(src, out, StripedShuffleHandler(data, radices), stats)
+
+def extract(src, striped=False, stats=None):
+    """
+    Extract the data hidden in the GIF src
+    """
+    if striped:
+        return run(src, None, StripedShuffleHandler(), stats)
+    return run(src, None, ShuffleHandler(), stats)
+
+def steg(in_path, out_path=None, data=None, striped=False, stats=None):
+    """
+    The steg function (use the ordering of the color table entries to hide the data)
+
+    If striped is set, split the data across all the color tables instead of
+    hiding a copy in each (see StripedShuffleHandler).
+    """
+    if out_path is None:
+        return extract(in_path, striped, stats)
+    return hide(in_path, data, out_path, striped, stats)
@@ -0,0 +1,154 @@
+"""
+The instrumentation of the GIF steganography suite
+
+A run only records anything when asked to, by passing a stats callback to a
+method's hide or extract (or to gif_parser.run), which is then called with a
+report once the run is over. Methods that need a first pass over the input
+(lsb with bits, striped shuffle) report each pass separately. Only then are
+the handler, the files and the parser's event stream wrapped in the recording
+versions here, so a normal run pays nothing for them.
+
+Each phase gets its call count and its wall and CPU (per thread) time:
+    parse           walking the structure of the input
+    <event type>    the handler's work on that kind of element (color_table,
+                    image_data, trailing, ...)
+    output          the calls that copy and write the output
+"""
+
+import time
+
+class Stats(object):
+    """
+    Phase timers and counters for one run
+    """
+
+    def __init__(self):
+        super(Stats, self).__init__()
+        # Phase name -> [calls, wall seconds, CPU seconds]
+        self.phases = {}
+        self.counts = {}
+        self.info = {}
+
+    def add(self, name, wall, cpu):
+        """
+        Record one call of a phase
+        """
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = self.phases[name] = [0, 0.0, 0.0]
+        phase[0] += 1
+        phase[1] += wall
+        phase[2] += cpu
+
+    def count(self, name, amount=1):
+        """
+        Add to a counter
+        """
+        self.counts[name] = self.counts.get(name, 0) + amount
+
+    def timed(self, name, func, *args):
+        """
+        Call func, recording the time it took against a phase
+        """
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            return func(*args)
+        finally:
+            self.add(name, time.perf_counter() - wall, time.thread_time() - cpu)
+
+    def timed_events(self, events):
+        """
+        Pass through the parser's events, timing the parser and counting the elements
+        """
+        while True:
+            wall, cpu = time.perf_counter(), time.thread_time()
+            event = next(events, None)
+            self.add('parse', time.perf_counter() - wall, time.thread_time() - cpu)
+            if event is None:
+                return
+            kind = type(event).__name__
+            if kind in EVENT_COUNTS:
+                self.count(EVENT_COUNTS[kind])
+            if kind in SUB_BLOCK_STARTS and event.data is not None:
+                self.count('sub_blocks', count_sub_blocks(event.data, SUB_BLOCK_STARTS[kind]))
+            yield event
+
+    def report(self):
+        """
+        Everything recorded, as a JSON-ready dict
+        """
+        return dict(self.info,
+                    phases={name: {'calls': calls, 'wall_s': round(wall, 6), 'cpu_s': round(cpu, 6)}
+                            for name, (calls, wall, cpu) in self.phases.items()},
+                    counts=dict(self.counts))
+
+# What each kind of element is counted as
+EVENT_COUNTS = {
+    'ColorTable': 'color_tables',
+    'ImageDescriptor': 'frames',
+    'Extension': 'extensions',
+}
+
+# Where the sub-blocks start in the elements that have them
+SUB_BLOCK_STARTS = {
+    'ImageData': 1,
+    'Extension': 2,
+}
+
+def count_sub_blocks(data, start):
+    """
+    The number of sub-blocks (including the terminator) in a raw element
+    """
+    count = 0
+    pos = start
+    while pos < len(data):
+        count += 1
+        pos += data[pos] + 1
+    return count
+
+class TimedHandler(object):
+    """
+    Wraps a Handler, timing each of its calls against the phase named for it
+    """
+
+    def __init__(self, handler, stats):
+        super(TimedHandler, self).__init__()
+        self.handler = handler
+        self.stats = stats
+
+    def __getattr__(self, name):
+        attr = getattr(self.handler, name)
+        if not callable(attr) or name == 'result':
+            return attr
+        return lambda event: self.stats.timed(name, attr, event)
+
+class CountingFile(object):
+    """
+    Wraps a binary file object, counting the calls that move data and the bytes they move
+    """
+
+    def __init__(self, f, stats):
+        super(CountingFile, self).__init__()
+        self.f = f
+        self.stats = stats
+
+    def read(self, *args):
+        data = self.f.read(*args)
+        self.stats.count('read_calls')
+        self.stats.count('read_bytes', len(data))
+        return data
+
+    def readinto(self, buf):
+        size = self.f.readinto(buf)
+        self.stats.count('read_calls')
+        self.stats.count('read_bytes', size or 0)
+        return size
+
+    def write(self, data):
+        size = self.f.write(data)
+        self.stats.count('write_calls')
+        self.stats.count('write_bytes', len(data))
+        return size
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
@@ -0,0 +1,252 @@
+"""
+The structure index cache of the GIF steganography suite
+
+Walking a GIF means following every sub-block chain of every image, which is
+most of the work of an extraction and a good part of a hide. Carriers that
+are used over and over have the same structure every time, so the walk is
+recorded once: the offset and size of every element, with the label of each
+Extension Block, the LZW Minimum Code Size of each image and which Color
+Table is the global one. Later runs over the same file rebuild the events
+straight from the index, slicing each element out of the mapped file without
+looking at the bytes in between.
+
+Entries are kept in an SQLite database (so worker processes can share it),
+with the most recently used ones also held in memory. Each entry is keyed by
+the file's path and checked against its size, modification time and inode
+on every use, which costs a single fstat. Entries that don't match are
+dropped, and the least recently used ones are evicted once the database goes
+over its size cap.
+"""
+
+from collections import OrderedDict
+import os
+import sqlite3
+import struct
+import threading
+import time
+
+from gif_parser import (DISPATCH, ColorTable, Extension, Header, ImageData, Trailer, Trailing,
+                        image_descriptor_event, screen_descriptor_event, use_structure_index)
+
+# Where the index is kept by default
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'gifsteg', 'index.sqlite')
+
+# How big the entries in the database may get before the least recently used
+# ones are evicted
+DEFAULT_MAX_BYTES = 64 << 20
+
+# How many entries to keep in memory as well
+MEMORY_ENTRIES = 1024
+
+# What to bring the size of the entries down to when evicting, as a fraction of
+# the cap (so that evicting isn't needed again on the very next write)
+EVICT_TO = 0.9
+
+# How stale the recorded last use of an entry may get before it is updated
+# (so that a hit doesn't have to write to the database every time)
+TOUCH_INTERVAL = 60
+
+# One element of a file: its kind (see KINDS), an extra detail (the label of
+# an Extension Block, the LZW Minimum Code Size of Image Data, whether a Color
+# Table is the global one), its offset and its size
+RECORD = struct.Struct('<BBQQ')
+
+# The element kinds, by their number in a record (named as in gif_parser.DISPATCH)
+KINDS = ('header', 'screen_descriptor', 'color_table', 'image_descriptor', 'image_data', 'extension',
+         'trailer', 'trailing')
+KIND_NUMBERS = {kind: number for number, kind in enumerate(KINDS)}
+
+def file_key(stat):
+    """
+    What an entry has to match to still describe a file, from its os.stat result
+    """
+    return f'{stat.st_size}:{stat.st_mtime_ns}:{stat.st_dev}:{stat.st_ino}'
+
+def element(event):
+    """
+    The kind number, detail and offset of the element an event stands for
+    """
+    if isinstance(event, ColorTable):
+        detail = int(event.is_global)
+    elif isinstance(event, ImageData):
+        detail = event.lzw_min_size
+    elif isinstance(event, Extension):
+        detail = event.label
+    else:
+        detail = 0
+    return KIND_NUMBERS[DISPATCH[type(event)]], detail, event.offset
+
+def pack_records(elements, size):
+    """
+    The index of a file of size bytes, from its elements (see element)
+    """
+    records = bytearray()
+    ends = [offset for _, _, offset in elements[1:]] + [size]
+    for (kind, detail, offset), end in zip(elements, ends):
+        records += RECORD.pack(kind, detail, offset, end - offset)
+    return bytes(records)
+
+def replay(records, buf):
+    """
+    Yield the events of a file from its index, with their data sliced out of buf
+    """
+    for kind, detail, offset, size in RECORD.iter_unpack(records):
+        data = buf[offset:offset + size]
+        kind = KINDS[kind]
+        if kind == 'header':
+            yield Header(offset, data, bytes(data[:3]), bytes(data[3:6]))
+        elif kind == 'screen_descriptor':
+            yield screen_descriptor_event(offset, data)
+        elif kind == 'color_table':
+            yield ColorTable(offset, data, bool(detail))
+        elif kind == 'image_descriptor':
+            yield image_descriptor_event(offset, data)
+        elif kind == 'image_data':
+            yield ImageData(offset, data, detail)
+        elif kind == 'extension':
+            yield Extension(offset, data, detail)
+        elif kind == 'trailer':
+            yield Trailer(offset, data)
+        else:
+            yield Trailing(offset, data)
+
+class StructureIndex(object):
+    """
+    A persistent cache of the structure of GIF files, by path
+
+    Safe to share between threads, and between processes through the database
+    file at path. Any trouble with the database just means a miss, so a run
+    never fails for the sake of the cache.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, max_bytes=DEFAULT_MAX_BYTES, memory_entries=MEMORY_ENTRIES):
+        super(StructureIndex, self).__init__()
+        self.path = path
+        self.max_bytes = max_bytes
+        self.memory_entries = memory_entries
+        # Absolute path -> [key, records, when the last use was recorded]
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        # A connection per thread (and per process, after a fork)
+        self.local = threading.local()
+
+    def connect(self):
+        """
+        The calling thread's connection to the database
+        """
+        if getattr(self.local, 'pid', None) != os.getpid():
+            db_dir = os.path.dirname(self.path)
+            if db_dir:
+                os.makedirs(db_dir, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS entries '
+                         '(path TEXT PRIMARY KEY, key TEXT NOT NULL, records BLOB NOT NULL, last_used REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)')
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return self.local.conn
+
+    def remember(self, path, entry):
+        """
+        Hold an entry in memory, forgetting the least recently used one if there are too many
+        """
+        with self.lock:
+            self.memory[path] = entry
+            self.memory.move_to_end(path)
+            while len(self.memory) > self.memory_entries:
+                self.memory.popitem(last=False)
+
+    def get(self, path, key):
+        """
+        The index of the file at path, if there is one that matches key (see file_key)
+
+        An entry that doesn't match is dropped.
+        """
+        path = os.path.abspath(path)
+        with self.lock:
+            entry = self.memory.get(path)
+            if entry is not None:
+                if entry[0] == key:
+                    self.memory.move_to_end(path)
+                else:
+                    del self.memory[path]
+                    entry = None
+        try:
+            conn = self.connect()
+            if entry is None:
+                row = conn.execute('SELECT key, records, last_used FROM entries WHERE path = ?', (path,)).fetchone()
+                if row is None:
+                    return None
+                if row[0] != key:
+                    conn.execute('DELETE FROM entries WHERE path = ? AND key = ?', (path, row[0]))
+                    return None
+                entry = list(row)
+                self.remember(path, entry)
+            now = time.time()
+            if now - entry[2] > TOUCH_INTERVAL:
+                entry[2] = now
+                conn.execute('UPDATE entries SET last_used = ? WHERE path = ?', (now, path))
+        except (OSError, sqlite3.Error):
+            pass
+        return entry[1] if entry is not None else None
+
+    def put(self, path, key, records):
+        """
+        Store the index of the file at path, evicting old entries if the database is over its cap
+        """
+        path = os.path.abspath(path)
+        now = time.time()
+        self.remember(path, [key, records, now])
+        try:
+            conn = self.connect()
+            conn.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)', (path, key, records, now))
+            self.evict(conn)
+        except (OSError, sqlite3.Error):
+            pass
+
+    def evict(self, conn):
+        """
+        Drop the least recently used entries until the database is back under its cap
+        """
+        total = conn.execute('SELECT COALESCE(SUM(LENGTH(records)), 0) FROM entries').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        doomed = []
+        for path, size in conn.execute('SELECT path, LENGTH(records) FROM entries ORDER BY last_used'):
+            if total <= self.max_bytes * EVICT_TO:
+                break
+            doomed.append((path,))
+            total -= size
+        conn.executemany('DELETE FROM entries WHERE path = ?', doomed)
+
+    def events(self, path, stat, buf, parse):
+        """
+        The events of the file at path (mapped as buf, with os.stat result stat)
+
+        Replayed from the index if it has an up to date entry, otherwise
+        parse is called for them and they are recorded as they go by.
+        """
+        key = file_key(stat)
+        records = self.get(path, key)
+        if records is not None:
+            return replay(records, buf)
+        return self.recording(path, key, stat.st_size, parse())
+
+    def recording(self, path, key, size, events):
+        """
+        Pass the events through, storing the index once they have all gone by
+        """
+        elements = []
+        for event in events:
+            elements.append(element(event))
+            yield event
+        # Only a complete walk gets stored
+        self.put(path, key, pack_records(elements, size))
+
+def install(path=DEFAULT_PATH, max_bytes=DEFAULT_MAX_BYTES):
+    """
+    Consult a StructureIndex at path for every input given as a path from now on
+    """
+    use_structure_index(StructureIndex(path, max_bytes))
@@ -0,0 +1,43 @@
+"""
+Tests for the asyncio interface, on a thread pool and on a process pool
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import asyncio
+import os
+import pickle
+import unittest
+
+from async_steg import AsyncSteg
+from session import Session
+
+GIFS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'GIFs')
+
+class AsyncStegTest(unittest.TestCase):
+
+    def round_trip(self, steg):
+        """
+        Hide a payload in a sample with every method, and extract it again, through steg
+        """
+        async def run():
+            async with steg:
+                path = os.path.join(GIFS, 'smh.gif')
+                for method in ('comment', 'lsb', 'shuffle'):
+                    hidden = await steg.hide(method, path, b'async test')
+                    self.assertEqual(await steg.extract(method, hidden), b'async test')
+        asyncio.run(run())
+
+    def test_thread_pool(self):
+        self.round_trip(AsyncSteg(limit=2))
+
+    def test_process_pool(self):
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            self.round_trip(AsyncSteg(limit=2, executor=executor))
+
+    def test_session_pickles(self):
+        session = pickle.loads(pickle.dumps(Session('lsb', bits=2, compress='zlib')))
+        hidden = session.hide(os.path.join(GIFS, 'smh.gif'), b'pickled')
+        self.assertEqual(session.extract(hidden), b'pickled')
+
+if __name__ == '__main__':
+    unittest.main()
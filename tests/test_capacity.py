@@ -0,0 +1,71 @@
+"""
+Tests that the capacity of each method is exactly what it can hide
+"""
+
+import struct
+import unittest
+
+import gif_parser
+import lsb
+import lzw
+import palette
+import shuffle
+
+def make_gif(colors):
+    """
+    A 1x1 GIF with a Global Color Table of the given packed colors (a power of 2 of them, or none)
+    """
+    ct_bits = len(colors).bit_length() - 1
+    packed = 0x80 | (ct_bits - 1) if colors else 0
+    image = lzw.Encoder(max(2, ct_bits))
+    codes = image.feed(b'\x00') + image.finish()
+    return (b'GIF89a' + struct.pack('<HHBBB', 1, 1, packed, 0, 0) + palette.encode(colors) +
+            b',' + struct.pack('<HHHHB', 0, 0, 1, 1, 0) + bytes([max(2, ct_bits)]) +
+            gif_parser.make_sub_blocks(codes) + b';')
+
+def check_capacity(test, method, gif, **options):
+    """
+    Check that method can hide exactly as much data in gif as its capacity says
+    """
+    available = method.capacity(gif, **options)
+    if available < 0:
+        # Not even empty data fits
+        with test.assertRaises(RuntimeError):
+            method.hide(gif, b'', **options)
+        return
+    data = b'\xff' * available
+    test.assertEqual(bytes(method.extract(method.hide(gif, data, **options), **options)), data)
+    with test.assertRaises(RuntimeError):
+        method.hide(gif, data + b'\xff', **options)
+
+class LsbCapacityTest(unittest.TestCase):
+
+    def test_table_sizes(self):
+        for count in (0, 2, 4, 8, 16, 32, 64, 128, 256):
+            gif = make_gif(list(range(count)))
+            for bits in (None, 1, 2, 4):
+                with self.subTest(count=count, bits=bits):
+                    check_capacity(self, lsb, gif, bits=bits)
+
+class ShuffleCapacityTest(unittest.TestCase):
+
+    def check_capacity(self, gif):
+        for striped in (False, True):
+            with self.subTest(striped=striped):
+                check_capacity(self, shuffle, gif, striped=striped)
+
+    def test_thirteen_colors(self):
+        # 13! needs 33 bits, one short of the 4 bytes (and leading 1 bit) it seems to have room for
+        gif = make_gif(list(range(13)) + [0, 1, 2])
+        self.assertEqual(shuffle.capacity(gif), 3)
+        self.check_capacity(gif)
+
+    def test_table_sizes(self):
+        self.check_capacity(make_gif([]))
+        for count in (2, 4, 8, 16, 32, 64, 128, 256):
+            for unique in sorted({1, 2, count // 2 + 1, count - 1, count}):
+                with self.subTest(count=count, unique=unique):
+                    self.check_capacity(make_gif([(i % unique) * 0x010101 for i in range(count)]))
+
+if __name__ == '__main__':
+    unittest.main()
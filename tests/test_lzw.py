@@ -0,0 +1,91 @@
+"""
+Tests for the GIF LZW codec, over the image data of the sample GIFs
+"""
+
+import os
+import random
+import unittest
+
+import gif_parser
+import lzw
+
+GIFS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'GIFs')
+
+def sample_frames(names=('smh.gif', 'heart.gif', 'csi.gif')):
+    """
+    The LZW Minimum Code Size and code stream of every frame of some of the samples
+    """
+    frames = []
+    for name in names:
+        with open(os.path.join(GIFS, name), 'rb') as in_f:
+            data = in_f.read()
+        for event in gif_parser.parse(gif_parser.BufferReader(data)):
+            if isinstance(event, gif_parser.ImageData):
+                frames.append((event.lzw_min_size, gif_parser.sub_block_data(event.data, 1)))
+    return frames
+
+def decode(lzw_min_size, codes):
+    return bytes(lzw.Decoder(lzw_min_size).feed(codes))
+
+class LZWTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.frames = sample_frames()
+
+    def setUp(self):
+        self.random = random.Random(0)
+
+    def test_decode_by_sub_block(self):
+        for lzw_min_size, codes in self.frames:
+            decoder = lzw.Decoder(lzw_min_size)
+            pieces = bytearray()
+            for pos in range(0, len(codes), 255):
+                pieces += decoder.feed(codes[pos:pos + 255])
+            self.assertEqual(bytes(pieces), decode(lzw_min_size, codes))
+
+    def test_encode_round_trip(self):
+        encoder = lzw.Encoder(2)
+        for lzw_min_size, codes in self.frames:
+            indices = decode(lzw_min_size, codes)
+            # The same Encoder restarted for each frame, fed in uneven pieces
+            encoder.restart(lzw_min_size)
+            encoded = bytearray()
+            for pos in range(0, len(indices), 1000):
+                encoded += encoder.feed(indices[pos:pos + 1000])
+            encoded += encoder.finish()
+            self.assertEqual(decode(lzw_min_size, encoded), indices)
+            fresh = lzw.Encoder(lzw_min_size)
+            self.assertEqual(fresh.feed(indices) + fresh.finish(), encoded)
+
+    def test_encode_wider_code_size(self):
+        for lzw_min_size, codes in self.frames[:5]:
+            indices = decode(lzw_min_size, codes)
+            encoder = lzw.Encoder(8)
+            self.assertEqual(decode(8, encoder.feed(indices) + encoder.finish()), indices)
+
+    def check_translate(self):
+        for lzw_min_size, codes in self.frames:
+            order = list(range(1 << lzw_min_size))
+            self.random.shuffle(order)
+            table = bytes(order + list(range(len(order), 256)))
+            translated = lzw.translate_codes(codes, lzw_min_size, table)
+            self.assertEqual(len(translated), len(codes))
+            self.assertEqual(decode(lzw_min_size, translated), decode(lzw_min_size, codes).translate(table))
+
+            # An index past the literals can't be patched in
+            if lzw_min_size < 8:
+                self.assertIsNone(lzw.translate_codes(codes, lzw_min_size, bytes([255]) * 256))
+
+    def test_translate(self):
+        self.check_translate()
+
+    def test_translate_pure_python(self):
+        numpy, lzw.numpy = lzw.numpy, None
+        try:
+            self.check_translate()
+        finally:
+            lzw.numpy = numpy
+
+if __name__ == '__main__':
+    unittest.main()
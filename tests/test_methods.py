@@ -0,0 +1,172 @@
+"""
+Golden tests for every steganography method over the sample GIFs
+
+Each method (and each of its variants) hides a fixed payload in every sample
+GIF. The output has to match the digest recorded in golden.json, so any
+change to the output shows up here, and the payload has to come back out
+again. The same output has to come out whatever kind of input and output the
+method is given.
+
+After a deliberate change to the output, rewrite golden.json with:
+
+    python -m tests.test_methods --regenerate
+"""
+
+import hashlib
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+from session import Session
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GIFS = os.path.join(ROOT, 'GIFs')
+GOLDEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'golden.json')
+
+# Every method, with each set of options worth covering, by variant name
+VARIANTS = {
+    'append': ('append', {}),
+    'comment': ('comment', {}),
+    'extension': ('extension', {}),
+    'lsb': ('lsb', {}),
+    'lsb-bits1': ('lsb', {'bits': 1}),
+    'lsb-bits2': ('lsb', {'bits': 2}),
+    'lsb-bits4': ('lsb', {'bits': 4}),
+    'shuffle': ('shuffle', {}),
+    'shuffle-striped': ('shuffle', {'striped': True}),
+}
+
+# The most data hidden in a sample, so the methods without a limit stay quick
+MAX_PAYLOAD = 4096
+
+def sample_names():
+    """
+    The names of the sample GIFs
+    """
+    return sorted(name for name in os.listdir(GIFS) if name.endswith('.gif'))
+
+def payload(session, path):
+    """
+    The data hidden in a sample: as much of a fixed pattern as the sample can hold
+    """
+    available = session.capacity(path)
+    size = MAX_PAYLOAD if available is None else min(available, MAX_PAYLOAD)
+    return bytes((i * 7 + 3) & 0xFF for i in range(size))
+
+def digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+def golden_outputs():
+    """
+    The digest of what every variant makes of every sample, by variant and sample name
+    """
+    outputs = {}
+    for variant, (method, options) in VARIANTS.items():
+        session = Session(method, **options)
+        for name in sample_names():
+            path = os.path.join(GIFS, name)
+            outputs[f'{variant}/{name}'] = digest(session.hide(path, payload(session, path)))
+    return outputs
+
+class GoldenTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        with open(GOLDEN, encoding='utf-8') as golden_f:
+            cls.golden = json.load(golden_f)
+
+    def test_outputs_match_golden(self):
+        for variant, (method, options) in VARIANTS.items():
+            session = Session(method, **options)
+            for name in sample_names():
+                with self.subTest(variant=variant, name=name):
+                    path = os.path.join(GIFS, name)
+                    data = payload(session, path)
+                    hidden = session.hide(path, data)
+                    self.assertEqual(digest(hidden), self.golden[f'{variant}/{name}'])
+                    self.assertEqual(session.extract(hidden), data)
+
+class ByteIdentityTest(unittest.TestCase):
+    """
+    The same output whatever the input and output are given as
+    """
+
+    # Small enough to go through every variant quickly
+    NAMES = ('smh.gif', 'heart.gif')
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+
+    def test_inputs(self):
+        for variant, (method, options) in VARIANTS.items():
+            session = Session(method, **options)
+            for name in self.NAMES:
+                with self.subTest(variant=variant, name=name):
+                    path = os.path.join(GIFS, name)
+                    data = payload(session, path)
+                    expected = session.hide(path, data)
+                    with open(path, 'rb') as in_f:
+                        raw = in_f.read()
+                        in_f.seek(0)
+                        self.assertEqual(session.hide(in_f, data), expected)
+                    self.assertEqual(session.hide(raw, data), expected)
+                    self.assertEqual(session.hide(bytearray(raw), data), expected)
+                    self.assertEqual(session.hide(io.BytesIO(raw), data), expected)
+
+    def test_outputs(self):
+        for variant, (method, options) in VARIANTS.items():
+            session = Session(method, **options)
+            for name in self.NAMES:
+                with self.subTest(variant=variant, name=name):
+                    path = os.path.join(GIFS, name)
+                    data = payload(session, path)
+                    expected = session.hide(path, data)
+                    out_path = os.path.join(self.tmp, f'{variant}-{name}')
+                    self.assertIsNone(session.hide(path, data, out_path))
+                    with open(out_path, 'rb') as out_f:
+                        self.assertEqual(out_f.read(), expected)
+                    with open(out_path, 'wb') as out_f:
+                        session.hide(path, data, out_f)
+                    with open(out_path, 'rb') as out_f:
+                        self.assertEqual(out_f.read(), expected)
+                    out_f = io.BytesIO()
+                    session.hide(path, data, out_f)
+                    self.assertEqual(out_f.getvalue(), expected)
+
+    def test_pipe_output(self):
+        read_fd, write_fd = os.pipe()
+        with open(read_fd, 'rb') as read_f, open(write_fd, 'wb') as write_f:
+            path = os.path.join(GIFS, 'smh.gif')
+            session = Session('comment')
+            expected = session.hide(path, b'piped')
+            # The pipe can hold all of a small GIF, so no reader is needed
+            session.hide(path, b'piped', write_f)
+            write_f.close()
+            self.assertEqual(read_f.read(), expected)
+
+    def test_extract_inputs(self):
+        for variant, (method, options) in VARIANTS.items():
+            session = Session(method, **options)
+            with self.subTest(variant=variant):
+                path = os.path.join(GIFS, 'smh.gif')
+                data = payload(session, path)
+                hidden = session.hide(path, data)
+                out_path = os.path.join(self.tmp, f'{variant}.gif')
+                with open(out_path, 'wb') as out_f:
+                    out_f.write(hidden)
+                self.assertEqual(session.extract(out_path), data)
+                self.assertEqual(session.extract(io.BytesIO(hidden)), data)
+                self.assertEqual(session.steg(out_path), data)
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['--regenerate']:
+        with open(GOLDEN, 'w', encoding='utf-8') as golden_f:
+            json.dump(golden_outputs(), golden_f, indent=2, sort_keys=True)
+            golden_f.write('\n')
+    else:
+        unittest.main()
@@ -0,0 +1,86 @@
+"""
+Tests for the permutation ranking helpers, against the original quadratic versions
+"""
+
+import random
+import unittest
+
+from permutation import factorial, from_mixed_radix, rank, to_mixed_radix, unrank
+
+def reference_rank(order):
+    """
+    The rank of an order, the way shuffle.extract_data used to work it out
+    """
+    positions = list(order)
+    number = 0
+    for i in range(len(positions) - 1):
+        pos = positions[i]
+        number *= len(positions) - i
+        number += pos
+        # Shift subsequent positions down
+        for j in range(i + 1, len(positions)):
+            if positions[j] > pos:
+                positions[j] -= 1
+    return number
+
+def reference_unrank(number, n):
+    """
+    The order with a rank, the way shuffle.hide_data used to work it out
+    """
+    positions = [0] * n
+    for i in range(n):
+        positions[n - i - 1] = number % (i + 1)
+        number //= i + 1
+    placed = [0] * n
+    for i in range(n):
+        item = n - i - 1
+        pos = positions[item]
+        # Shift items up as needed to make room
+        placed[pos + 1:] = placed[pos:-1]
+        placed[pos] = item
+    order = [0] * n
+    for slot, item in enumerate(placed):
+        order[item] = slot
+    return order
+
+class PermutationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.random = random.Random(0)
+
+    def test_small_permutations_exhaustively(self):
+        for n in range(1, 7):
+            for number in range(factorial(n)):
+                order = unrank(number, n)
+                self.assertEqual(order, reference_unrank(number, n))
+                self.assertEqual(rank(order), number)
+
+    def test_matches_reference(self):
+        for n in (8, 16, 64, 100, 255, 256):
+            for _ in range(20):
+                order = list(range(n))
+                self.random.shuffle(order)
+                number = reference_rank(order)
+                self.assertEqual(rank(order), number)
+                self.assertEqual(unrank(number, n), order)
+
+    def test_extremes(self):
+        for n in (1, 2, 256):
+            self.assertEqual(unrank(0, n), list(range(n)))
+            self.assertEqual(unrank(factorial(n) - 1, n), list(range(n))[::-1])
+            self.assertEqual(rank(list(range(n))[::-1]), factorial(n) - 1)
+
+    def test_mixed_radix_round_trip(self):
+        for count in (1, 2, 15, 16, 17, 100, 1000):
+            radices = [self.random.randint(1, 300) for _ in range(count)]
+            digits = [self.random.randrange(radix) for radix in radices]
+            number = from_mixed_radix(digits, radices)
+            # Most significant digit first
+            expected = 0
+            for digit, radix in zip(digits, radices):
+                expected = expected * radix + digit
+            self.assertEqual(number, expected)
+            self.assertEqual(to_mixed_radix(number, radices), digits)
+
+if __name__ == '__main__':
+    unittest.main()
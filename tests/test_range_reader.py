@@ -0,0 +1,76 @@
+"""
+Tests for extracting from range-addressable sources (see gif_parser.RangeReader)
+"""
+
+import os
+import tempfile
+import unittest
+
+import append
+import comment
+import extension
+import gif_parser
+import lsb
+
+GIFS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'GIFs')
+
+def structure_size(path):
+    """
+    How many bytes of a GIF aren't image data: the most an extraction should fetch
+    """
+    with open(path, 'rb') as in_f:
+        data = in_f.read()
+    size = 0
+    for event in gif_parser.parse(gif_parser.BufferReader(data)):
+        if not isinstance(event, gif_parser.ImageData):
+            size += len(event.data)
+            continue
+        # The LZW Minimum Code Size and the size of every sub-block
+        size += 1
+        pos = event.offset + 1
+        while True:
+            block_size = data[pos]
+            size += 1
+            pos += block_size + 1
+            if block_size == 0:
+                break
+    return size
+
+class RangeReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+
+    def carrier(self, method, name):
+        """
+        A copy of one of the sample GIFs with a payload hidden by method, written to a file
+        """
+        path = os.path.join(self.tmp, f'{method.__name__}-{name}')
+        method.hide(os.path.join(GIFS, name), b'range test', path)
+        return path
+
+    def test_matches_extracting_from_the_file(self):
+        for method in (append, comment, extension, lsb):
+            for name in ('smh.gif', 'snow.gif'):
+                with self.subTest(method=method.__name__, name=name):
+                    path = self.carrier(method, name)
+                    source = gif_parser.FileRangeSource(path)
+                    self.assertEqual(bytes(method.extract(source)), b'range test')
+                    self.assertEqual(bytes(method.extract(source)), bytes(method.extract(path)))
+
+    def test_fetches_little_more_than_the_structure(self):
+        path = self.carrier(lsb, 'cat2.gif')
+        needed = structure_size(path)
+        exact = gif_parser.FileRangeSource(path, gap=0)
+        self.assertEqual(bytes(lsb.extract(exact)), b'range test')
+        self.assertLessEqual(exact.bytes_fetched, needed)
+        source = gif_parser.FileRangeSource(path)
+        self.assertEqual(bytes(lsb.extract(source)), b'range test')
+        self.assertLessEqual(source.bytes_fetched, needed * 11 // 10)
+        # Nearby elements share a range
+        self.assertLess(source.requests, exact.requests)
+
+if __name__ == '__main__':
+    unittest.main()